@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import tempfile
+import pandas as pd
+from src.data import read_raw, clean_data
+from src.data.dtypes import footprint
+from src.helpers.profiling import profile
+from .run import Recorder
+from .synthetic import write_synthetic
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', nargs='?',
+                        help='raw file, synthetic if not given')
+    parser.add_argument('--users', type=int, default=1_000)
+    parser.add_argument('--max-ratio', type=float, default=1.0,
+                        help='fail if no-copy peak exceeds this share of '
+                             'copy peak')
+    parser.add_argument('--engine', choices=['pandas', 'arrow'],
+                        default='pandas')
+    parser.add_argument('--steps', action='store_true',
+                        help='report memory of frame after each step')
+    return parser.parse_args()
+
+
+def compare(df):
+    """Compare clean_data with and without defensive copies.
+
+    Raises if outputs differ. Returns table of time and peak memory.
+    """
+    recorder = Recorder()
+    results = {}
+    with recorder.tracing():
+        for copy in [True, False]:
+            with recorder.stage(copy):
+                results[copy] = profile.call(clean_data, df, copy=copy)
+    pd.testing.assert_frame_equal(results[True], results[False])
+    tbl = recorder.table()
+    tbl = (tbl[tbl.depth == 0]
+           .set_index('stage').rename_axis('copy')[['seconds', 'peak_mb']])
+    tbl['peak_ratio'] = tbl.peak_mb / tbl.loc[True, 'peak_mb']
+    return tbl
+
+
+def check_peaks(tbl, max_ratio=1.0):
+    """Raise if peak memory without copies exceeds max_ratio of that with."""
+    ratio = tbl.loc[False, 'peak_ratio']
+    if ratio > max_ratio:
+        raise AssertionError(f'Peak memory without copies is {ratio:.2f} '
+                             f'times that with copies (max {max_ratio}).')
+
+
+def step_footprints(df):
+    """Return memory of frame before and after each cleaning step."""
+    recorder = Recorder(memory=False, deep=True)
+    with recorder.tracing(), recorder.stage('clean_data'):
+        result = clean_data(df)
+    return recorder.table()[['step', 'mb_in', 'mb_out']], result
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    if args.path is None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'raw.csv')
+            write_synthetic(path, args.users)
+            df = read_raw(path, engine=args.engine)
+    else:
+        df = read_raw(args.path, engine=args.engine)
+    print(f'Input: {df.memory_usage(deep=True).sum() / 1e6:,.1f} MB')
+    tbl = compare(df)
+    print(tbl)
+    check_peaks(tbl, args.max_ratio)
+    if args.steps:
+        tbl, result = step_footprints(df)
+        print(tbl.to_string(index=False, float_format='{:,.1f}'.format))
+        print(footprint(result).div(1e6).sort_values(ascending=False)
+              .to_string(float_format='{:,.2f}'.format))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
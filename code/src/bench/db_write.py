@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from src.db.database import CHUNK_ROWS, close_all, connection, insert_frame
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200_000)
+    parser.add_argument('--features', type=int, default=50)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def synthetic_features(num_users, num_features, seed=0, missing=.1):
+    """Return wide feature table with a share of missing values."""
+    rng = np.random.default_rng(seed)
+    values = rng.random((num_users, num_features))
+    values[rng.random(values.shape) < missing] = np.nan
+    df = pd.DataFrame(values,
+                      columns=[f'feature_{i}' for i in range(num_features)])
+    df.insert(0, 'user_id', np.arange(num_users))
+    return df
+
+
+def write_to_sql(df, path, chunk_rows):
+    """Write table with pandas on a default connection."""
+    conn = sqlite3.connect(path)
+    df.to_sql('features', conn, index=False)
+    conn.commit()
+    conn.close()
+
+
+def write_bulk(df, path, chunk_rows):
+    """Write table with chunked executemany on a pooled connection."""
+    with connection(path) as conn:
+        insert_frame(df, 'features', conn, chunk_rows)
+
+
+def compare(num_users, num_features, chunk_rows=CHUNK_ROWS, seed=0):
+    """Compare write throughput of to_sql and bulk inserts.
+
+    Raises if written tables differ. Returns table of seconds and rows
+    per second of each method.
+    """
+    df = synthetic_features(num_users, num_features, seed)
+    rows = []
+    tables = {}
+    with tempfile.TemporaryDirectory() as tempdir:
+        for name, write in [('to_sql', write_to_sql),
+                            ('executemany', write_bulk)]:
+            path = os.path.join(tempdir, f'{name}.db')
+            start = time.perf_counter()
+            write(df, path, chunk_rows)
+            secs = time.perf_counter() - start
+            rows.append({'method': name, 'seconds': secs,
+                         'rows_per_sec': len(df) / secs})
+            conn = sqlite3.connect(path)
+            tables[name] = pd.read_sql('select * from features', conn)
+            conn.close()
+        close_all()
+    pd.testing.assert_frame_equal(tables['to_sql'], tables['executemany'])
+    tbl = pd.DataFrame(rows).set_index('method')
+    tbl['speedup'] = tbl.loc['to_sql', 'seconds'] / tbl.seconds
+    return tbl
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    print(f'{args.users:,} users, {args.features} features')
+    print(compare(args.users, args.features, args.chunk_rows, args.seed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
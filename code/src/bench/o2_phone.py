@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import sys
+import time
+import numpy as np
+import pandas as pd
+from src.db.decisions import (
+    long_series,
+    large_payment,
+    rare_large_payment,
+    larger_than_neighbours,
+    multiple_payments,
+    classify_o2,
+)
+
+
+STAGES = [
+    long_series,
+    large_payment,
+    rare_large_payment,
+    larger_than_neighbours,
+    multiple_payments,
+    classify_o2,
+]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, nargs='+',
+                        default=[1_000, 10_000, 100_000, 1_000_000])
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def synthetic_o2(num_users, seed=0):
+    """Return synthetic o2 subset of monthly bills and phone payments.
+
+    Users pay a monthly airtime bill for one to four years, which is
+    constant for half of them. A third make an upfront phone payment, and
+    a third a second payment on bill days, as instalment payers do.
+    """
+    rng = np.random.default_rng(seed)
+    users = np.arange(num_users, dtype='int32')
+    months = rng.integers(12, 49, num_users)
+    start = pd.Timestamp('2012-01-01') + pd.to_timedelta(
+        rng.integers(0, 365, num_users), 'D')
+    bill = rng.integers(10, 60, num_users).astype('float32')
+    constant = rng.random(num_users) < .5
+
+    user = np.repeat(users, months)
+    month = np.arange(len(user)) - np.repeat(np.cumsum(months) - months,
+                                             months)
+    date = (np.repeat(start.to_numpy(), months)
+            + (month * 30.4).astype('timedelta64[D]'))
+    amount = np.repeat(bill, months)
+    noise = rng.integers(-5, 6, len(user)).astype('float32')
+    amount = np.where(np.repeat(constant, months), amount,
+                      np.maximum(amount + noise, 1))
+    bills = pd.DataFrame({'user_id': user, 'transaction_date': date,
+                          'amount': amount})
+
+    upfront = users[rng.random(num_users) < 1/3]
+    phones = pd.DataFrame({
+        'user_id': upfront,
+        'transaction_date': start[upfront] + pd.to_timedelta(
+            rng.integers(0, 365, len(upfront)), 'D'),
+        'amount': rng.integers(150, 800, len(upfront)).astype('float32'),
+    })
+    instalment = np.isin(bills.user_id, users[rng.random(num_users) < 1/3])
+    instalments = bills[instalment].assign(amount=lambda df: df.amount + 20)
+
+    df = pd.concat([bills, phones, instalments], ignore_index=True)
+    return df.sort_values(['user_id', 'transaction_date'], ignore_index=True)
+
+
+def run_stages(df):
+    """Return labels and seconds spent in each classification stage."""
+    secs = {}
+    for stage in STAGES:
+        start = time.perf_counter()
+        df = stage(df)
+        secs[stage.__name__] = time.perf_counter() - start
+    return df, secs
+
+
+def scaling(user_counts, seed=0):
+    """Return table of classification time by number of users."""
+    rows = []
+    for num_users in user_counts:
+        df = synthetic_o2(num_users, seed)
+        labels, secs = run_stages(df)
+        total = sum(secs.values())
+        rows.append({'users': num_users, 'rows': len(df), **secs,
+                     'seconds': total, 'rows_per_sec': len(df) / total,
+                     'labelled': labels.o2_phone.notna().mean()})
+    return pd.DataFrame(rows).set_index('users')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    with pd.option_context('display.width', 200, 'display.max_columns', 20,
+                           'display.precision', 3):
+        print(scaling(args.users, args.seed))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
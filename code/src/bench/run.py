@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+from src import config
+from src.data import read_raw, split_file, clean_data, select_sample
+from src.db.decisions import *
+from src.db.features import *
+from src.db.registries import (
+    decisions_registry,
+    features_registry,
+    intermediates_registry,
+)
+from src.db.scheduler import required_intermediates
+from src.helpers.profiling import profile
+from .synthetic import write_synthetic
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw', help='raw file, synthetic if not given')
+    parser.add_argument('--users', type=int, default=1_000)
+    parser.add_argument('--rows-per-user', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=['pandas', 'arrow'],
+                        default='pandas')
+    parser.add_argument('--no-memory', dest='memory', action='store_false')
+    parser.add_argument('--history',
+                        default=os.path.join(config.TEMPDIR,
+                                             'bench_history.json'))
+    return parser.parse_args()
+
+
+class Recorder:
+    """Record time and memory of pipeline steps from their profile.
+
+    Steps are the calls the pipeline profile records, which is enabled
+    while tracing. Peak memory is the peak of traced allocations during a
+    step above those at its start. Tracing slows steps down, so times are
+    only comparable between runs with the same memory setting.
+    """
+
+    def __init__(self, memory=True, deep=False):
+        self.memory = memory
+        self.deep = deep
+        self.records = []
+
+    @contextmanager
+    def tracing(self):
+        if self.memory:
+            tracemalloc.start()
+        try:
+            with profile.recording(self.deep):
+                yield
+        finally:
+            if self.memory:
+                tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, stage):
+        """Record profiled calls made in context as steps of stage."""
+        start = len(profile.records)
+        try:
+            yield
+        finally:
+            for r in profile.records[start:]:
+                peak = r['peak_traced']
+                self.records.append({
+                    'stage': stage,
+                    'step': r['step'],
+                    'depth': r['depth'],
+                    'seconds': r['wall'],
+                    'peak_mb': None if peak is None else peak / 1e6,
+                    'rows_in': r['rows_in'],
+                    'rows_out': r['rows_out'],
+                    'mb_in': mb(r['bytes_in']),
+                    'mb_out': mb(r['bytes_out']),
+                })
+
+    def table(self):
+        return pd.DataFrame(self.records)
+
+
+def mb(nbytes):
+    return None if nbytes is None else nbytes / 1e6
+
+
+def run_registered(funcs, df):
+    """Profile intermediates in order of definition, then functions."""
+    funcs = sorted(funcs, key=lambda f: f.__name__)
+    required = required_intermediates(funcs)
+    for inter in intermediates_registry.values():
+        if inter in required:
+            profile.call(inter, df)
+    for func in funcs:
+        profile.call(func, df)
+
+
+def run_pipeline(raw_path, recorder, engine='pandas'):
+    """Run pipeline stages on raw file, recording each step."""
+    with tempfile.TemporaryDirectory() as tempdir:
+        with recorder.stage('split_file'):
+            split_file(raw_path, tempdir, workers=1)
+    with recorder.stage('read_raw'):
+        df = read_raw(raw_path, engine=engine)
+    with recorder.stage('clean_data'):
+        df = clean_data(df)
+    with recorder.stage('select_sample'):
+        df = select_sample(df)
+    with recorder.stage('features'):
+        run_registered(features_registry, df)
+    with recorder.stage('decisions'):
+        run_registered(decisions_registry, df)
+
+
+def git_commit():
+    """Return current commit, or None outside a git repository."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_last(tbl, history, params):
+    """Add ratio of seconds to those of the last run with same params."""
+    previous = [run for run in history if run['params'] == params]
+    if not previous:
+        return tbl
+    last = pd.DataFrame(previous[-1]['records'])
+    last = last.set_index(['stage', 'step']).seconds
+    ratio = tbl.seconds / last.reindex(
+        pd.MultiIndex.from_frame(tbl[['stage', 'step']])).to_numpy()
+    return tbl.assign(vs_last=ratio)
+
+
+def benchmark(raw=None, users=1_000, rows_per_user=300, seed=0,
+              engine='pandas', memory=True, history=None):
+    """Run pipeline on raw or synthetic file and append to history.
+
+    Returns table of seconds, peak memory, and rows and megabytes in and
+    out of each step, with the ratio of seconds to the last run with the
+    same parameters if there is one. Steps of depth above zero run within
+    other steps, whose times include theirs.
+    """
+    params = {'raw': raw, 'engine': engine, 'memory': memory}
+    if raw is None:
+        params.update(users=users, rows_per_user=rows_per_user, seed=seed)
+    recorder = Recorder(memory)
+    with tempfile.TemporaryDirectory() as tempdir:
+        if raw is None:
+            raw_path = os.path.join(tempdir, 'raw.csv')
+            write_synthetic(raw_path, users, rows_per_user, seed=seed)
+        else:
+            raw_path = raw
+        params['raw_mb'] = os.path.getsize(raw_path) / 1e6
+        with recorder.tracing():
+            run_pipeline(raw_path, recorder, engine)
+
+    tbl = recorder.table()
+    runs = load_history(history) if history else []
+    tbl = compare_last(tbl, runs, params)
+    if history:
+        runs.append({
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'host': platform.node(),
+            'cpus': os.cpu_count(),
+            'params': params,
+            'records': recorder.records,
+        })
+        os.makedirs(os.path.dirname(os.path.abspath(history)), exist_ok=True)
+        with open(history, 'w') as f:
+            json.dump(runs, f, indent=1)
+    return tbl
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    tbl = benchmark(args.raw, args.users, args.rows_per_user, args.seed,
+                    args.engine, args.memory, args.history)
+    with pd.option_context('display.width', 200, 'display.max_rows', 200,
+                           'display.precision', 3):
+        print(tbl.to_string(index=False))
+        top = tbl[tbl.depth == 0]
+        print(top.groupby('stage', sort=False)[['seconds']].sum())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = [
+    'Transaction Reference',
+    'User Reference',
+    'Year of Birth',
+    'Salary Range',
+    'Postcode',
+    'LSOA',
+    'MSOA',
+    'Derived Gender',
+    'User Registration Date',
+    'Account Reference',
+    'Provider Group Name',
+    'Account Type',
+    'Latest Balance',
+    'Transaction Description',
+    'Credit Debit',
+    'Amount',
+    'User Precedence Tag Name',
+    'Manual Tag Name',
+    'Auto Purpose Tag Name',
+    'Merchant Name',
+    'Merchant Business Line',
+    'Transaction Updated Flag',
+    'Transaction Date',
+    'Account Created Date',
+    'Account Last Refreshed',
+    'Data Warehouse Date Created',
+    'Data Warehouse Date Last Updated',
+]
+
+START = np.datetime64('2012-01', 'M')
+
+# merchant, description, auto tag, mean amount, weight
+SHOPS = [
+    ('tesco', 'tesco stores', 'Food, Groceries, Household', 35, 8),
+    ('sainsburys', 'sainsburys s/mkts', 'Food, Groceries, Household', 40, 6),
+    ('aldi', 'aldi stores', 'Food, Groceries, Household', 25, 4),
+    ('amazon', 'amazon mktplace', 'Household', 30, 5),
+    ('amazon', 'amzn digital', 'Entertainment, TV, Media', 8, 2),
+    ('pret a manger', 'pret a manger', 'Lunch or snacks', 7, 5),
+    ('costa', 'costa coffee', 'Lunch or snacks', 4, 4),
+    ('nandos', 'nandos', 'Dining or going out', 28, 3),
+    ('zizzi', 'zizzi the o2', 'Dining or going out', 35, 1),
+    ('shell', 'shell garage', 'Fuel', 45, 3),
+    ('tfl', 'tfl travel ch', 'Public transport', 12, 4),
+    ('next', 'next retail', 'Clothes', 50, 2),
+    ('netflix', 'netflix.com', 'Entertainment, TV, Media', 9, 1),
+    (None, 'cash withdrawal', 'Cash', 60, 3),
+    (None, 'card payment', 'No Tag', 20, 1),
+]
+INCOMES = [
+    ('Salary or wages (main)', 1_800, 6),
+    ('Benefits', 700, 1),
+    ('Pension', 1_200, 1),
+    ('Rental income (whole property)', 900, 1),
+]
+INSURERS = ['aviva', 'direct line', 'admiral', 'churchill', 'lv']
+PROVIDERS = ['natwest', 'hsbc', 'barclays', 'lloyds', 'santander']
+SALARIES = ['< 10K', '10K to 20K', '20K to 30K', '30K to 40K', '40K to 50K',
+            '50K to 60K', '60K to 70K', '70K to 80K', '> 80K']
+
+# account slots of each user
+CURRENT, SAVINGS, CARD = 0, 1, 2
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--users', type=int, default=1_000)
+    parser.add_argument('--rows-per-user', type=int, default=300)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+class Users:
+    """Attributes of a chunk of synthetic users."""
+
+    def __init__(self, rng, first_id, num_users, months):
+        self.ids = np.arange(first_id, first_id + num_users)
+        self.num_months = rng.integers(months // 2, months + 1, num_users)
+        self.first_month = rng.integers(0, months - self.num_months + 1)
+        self.has_current = rng.random(num_users) < .95
+        self.has_savings = rng.random(num_users) < .6
+        self.has_card = rng.random(num_users) < .5
+        self.yob = rng.integers(1940, 2003, num_users).astype(float)
+        self.yob[rng.random(num_users) < .01] = np.nan
+        self.rng = rng
+
+    def __len__(self):
+        return len(self.ids)
+
+    def month_rows(self, prob=1.):
+        """Return user positions and months for one row per user-month."""
+        user = np.repeat(np.arange(len(self)), self.num_months)
+        offset = np.arange(len(user)) - np.repeat(
+            np.cumsum(self.num_months) - self.num_months, self.num_months)
+        month = self.first_month[user] + offset
+        keep = self.rng.random(len(user)) < prob
+        return user[keep], month[keep]
+
+    def dates(self, month, day):
+        """Return dates of day in month after START."""
+        days = (np.asarray(day) - 1).astype('timedelta64[D]')
+        months = np.asarray(month).astype('timedelta64[M]')
+        return (START + months).astype('datetime64[D]') + days
+
+
+def events(users, user, date, amount, credit, merchant, description, tag,
+           account=CURRENT):
+    """Return frame of events of users at positions user."""
+    n = len(user)
+    return pd.DataFrame({
+        'user': user,
+        'account': np.broadcast_to(account, n),
+        'date': date,
+        'amount': np.round(amount, 2),
+        'credit': np.broadcast_to(credit, n),
+        'merchant': np.broadcast_to(np.asarray(merchant, dtype=object), n),
+        'description': np.broadcast_to(
+            np.asarray(description, dtype=object), n),
+        'auto_tag': np.broadcast_to(np.asarray(tag, dtype=object), n),
+    })
+
+
+def spending(users, rows_per_user):
+    """Return card and cash spending, with a few refunds."""
+    rng = users.rng
+    counts = rng.poisson(rows_per_user * .8, len(users))
+    user = np.repeat(np.arange(len(users)), counts)
+    span = users.num_months[user] * 30
+    day = rng.integers(0, span)
+    start = users.dates(users.first_month[user], 1)
+    date = start + day.astype('timedelta64[D]')
+    weights = np.array([s[4] for s in SHOPS], dtype=float)
+    shop = rng.choice(len(SHOPS), len(user), p=weights / weights.sum())
+    mean = np.array([s[3] for s in SHOPS])[shop]
+    amount = rng.gamma(2, mean / 2)
+    uses_card = users.has_card[user] & (rng.random(len(user)) < .3)
+    account = np.where(uses_card, CARD, CURRENT)
+    credit = rng.random(len(user)) < .03
+    take = np.array([s[:3] for s in SHOPS], dtype=object)[shop]
+    return events(users, user, date, amount, credit, take[:, 0], take[:, 1],
+                  take[:, 2], account)
+
+
+def incomes(users):
+    """Return monthly incomes and rent.
+
+    Some users receive their income irregularly. Rent is paid monthly and
+    takes up to half of income.
+    """
+    rng = users.rng
+    weights = np.array([i[2] for i in INCOMES], dtype=float)
+    kind = rng.choice(len(INCOMES), len(users), p=weights / weights.sum())
+    level = (np.array([i[1] for i in INCOMES])[kind]
+             * rng.lognormal(0, .5, len(users)))
+    regular = rng.random(len(users)) < .8
+    payday = rng.integers(1, 29, len(users))
+    user, month = users.month_rows()
+    keep = rng.random(len(user)) < np.where(regular[user], .98, .5)
+    user, month = user[keep], month[keep]
+    amount = level[user] * rng.normal(1, .05, len(user))
+    tags = np.array([i[0] for i in INCOMES], dtype=object)[kind[user]]
+    income = events(users, user, users.dates(month, payday[user]),
+                    amount.clip(10), True, None, 'bacs credit', tags)
+    share = rng.uniform(.2, .5, len(users))
+    user, month = users.month_rows()
+    rent = events(users, user, users.dates(month, 1),
+                  level[user] * share[user], False, None, 'standing order',
+                  'Mortgage or rent')
+    return [income, rent]
+
+
+def transfers(users):
+    """Return transfers between current and savings account.
+
+    Each transfer is a debit and a credit of the same amount, up to two
+    days apart, as identified by tag_pmt_pairs.
+    """
+    rng = users.rng
+    user, month = users.month_rows(.5)
+    user, month = (user[users.has_savings[user]],
+                   month[users.has_savings[user]])
+    date = users.dates(month, rng.integers(1, 27, len(user)))
+    lag = rng.integers(0, 3, len(user)).astype('timedelta64[D]')
+    amount = rng.integers(1, 20, len(user)) * 50.
+    out = events(users, user, date, amount, False, None,
+                 'transfer to savings', 'Transfers')
+    into = events(users, user, date + lag, amount, True, None,
+                  'transfer from current', 'Transfers', SAVINGS)
+    return [out, into]
+
+
+def phone_bills(users):
+    """Return o2 airtime bills, phone purchases and instalments."""
+    rng = users.rng
+    has_o2 = rng.random(len(users)) < .4
+    bill = rng.integers(10, 60, len(users)).astype(float)
+    constant = rng.random(len(users)) < .5
+    user, month = users.month_rows()
+    user, month = user[has_o2[user]], month[has_o2[user]]
+    noise = np.where(constant[user], 0, rng.integers(-5, 6, len(user)))
+    date = users.dates(month, 15)
+    bills = events(users, user, date, np.maximum(bill[user] + noise, 1),
+                   False, 'o2', 'o2 uk bill', 'Mobile')
+    instalment = rng.random(len(users)) < 1/3
+    mask = instalment[user]
+    instalments = events(users, user[mask], date[mask],
+                         bill[user[mask]] + 20, False, 'o2', 'o2 uk bill',
+                         'Mobile')
+    upfront = np.flatnonzero(has_o2 & (rng.random(len(users)) < 1/3))
+    month = users.first_month[upfront] + rng.integers(
+        0, users.num_months[upfront])
+    phones = events(users, upfront, users.dates(month, 3),
+                    rng.integers(150, 800, len(upfront)), False, 'o2',
+                    'o2 store', 'Mobile')
+    return [bills, instalments, phones]
+
+
+def insurance(users):
+    """Return monthly or yearly home and vehicle insurance payments.
+
+    Users pay one insurer per year and some switch insurers each year.
+    """
+    rng = users.rng
+    result = []
+    for tag, share, monthly_amount in [('Vehicle insurance', .5, 45),
+                                       ('Home insurance', .4, 20)]:
+        insured = rng.random(len(users)) < share
+        monthly = rng.random(len(users)) < .6
+        switches = rng.random(len(users)) < .3
+        insurer = rng.integers(0, len(INSURERS), len(users))
+        premium = monthly_amount * rng.lognormal(0, .3, len(users))
+        user, month = users.month_rows()
+        mask = insured[user] & (monthly[user]
+                                | ((month - users.first_month[user]) % 12
+                                   == 0))
+        user, month = user[mask], month[mask]
+        year = (month - users.first_month[user]) // 12
+        name = np.array(INSURERS, dtype=object)[
+            (insurer[user] + switches[user] * year) % len(INSURERS)]
+        amount = np.where(monthly[user], premium[user], premium[user] * 11)
+        result.append(events(users, user, users.dates(month, 1),
+                             amount, False, name, name + ' insurance', tag))
+    return result
+
+
+def card_repayments(users):
+    """Return monthly credit card repayments from current accounts."""
+    rng = users.rng
+    user, month = users.month_rows()
+    user, month = user[users.has_card[user]], month[users.has_card[user]]
+    amount = rng.gamma(2, 150, len(user))
+    date = users.dates(month, 25)
+    return [events(users, user, date, amount, False, None,
+                   'credit card payment', 'Credit card repayment'),
+            events(users, user, date, amount, True, None,
+                   'payment received', 'Credit card repayment', CARD)]
+
+
+def synthetic_chunk(rng, first_id, first_txn, num_users, rows_per_user,
+                    months):
+    """Return raw rows of num_users users with ids from first_id."""
+    users = Users(rng, first_id, num_users, months)
+    df = pd.concat([spending(users, rows_per_user), *incomes(users),
+                    *transfers(users), *phone_bills(users),
+                    *insurance(users), *card_repayments(users)],
+                   ignore_index=True)
+    n = len(df)
+    user = df.user.to_numpy()
+    user_id = users.ids[user]
+    manual = np.where(rng.random(n) < .1, df.auto_tag, 'No Tag')
+    up = np.where(manual != 'No Tag', manual, df.auto_tag)
+    has_current = users.has_current[user]
+    account_type = np.array(['Current', 'Savings', 'Credit card'],
+                            dtype=object)[df.account]
+    account_type = np.where(~has_current & (df.account == CURRENT),
+                            'Savings', account_type)
+    provider = np.array(PROVIDERS, dtype=object)[
+        (user_id + df.account) % len(PROVIDERS)]
+    registered = users.dates(users.first_month, 1)[user]
+    salary = np.array(SALARIES, dtype=object)[user_id % len(SALARIES)]
+    raw = pd.DataFrame({
+        'Transaction Reference': first_txn + np.arange(n),
+        'User Reference': user_id,
+        'Year of Birth': users.yob[user],
+        'Salary Range': salary,
+        'Postcode': 'PC' + pd.Series(user_id % 97).astype(str),
+        'LSOA': 'E0' + pd.Series(user_id % 89).astype(str),
+        'MSOA': 'E1' + pd.Series(user_id % 83).astype(str),
+        'Derived Gender': np.array(['M', 'F', 'U'])[user_id % 3],
+        'User Registration Date': registered,
+        'Account Reference': user_id * 10 + df.account,
+        'Provider Group Name': provider,
+        'Account Type': account_type,
+        'Latest Balance': np.round(rng.normal(1_000, 500, n), 2),
+        'Transaction Description': df.description,
+        'Credit Debit': np.where(df.credit, 'Credit', 'Debit'),
+        'Amount': df.amount,
+        'User Precedence Tag Name': up,
+        'Manual Tag Name': manual,
+        'Auto Purpose Tag Name': df.auto_tag,
+        'Merchant Name': df.merchant,
+        'Merchant Business Line': 'unknown',
+        'Transaction Updated Flag': 'U',
+        'Transaction Date': df.date,
+        'Account Created Date': registered,
+        'Account Last Refreshed': '2014-06-01',
+        'Data Warehouse Date Created': '2014-06-01',
+        'Data Warehouse Date Last Updated': '2014-06-01',
+    })
+    return raw.sample(frac=1, random_state=rng.integers(2**32))[COLUMNS]
+
+
+def write_synthetic(path, num_users, rows_per_user=300, months=24, seed=0,
+                    chunk_users=10_000):
+    """Write pipe-delimited raw file of synthetic users.
+
+    Rows follow the schema of read_raw and include the patterns the
+    pipeline looks for: transfers between a user's accounts, regular and
+    irregular incomes, o2 bills with phone purchases and instalments, and
+    monthly or yearly insurance payments with insurer switches. Users are
+    generated in chunks, so memory does not grow with num_users. Returns
+    number of rows written.
+    """
+    rng = np.random.default_rng(seed)
+    rows = 0
+    for first in range(0, num_users, chunk_users):
+        size = min(chunk_users, num_users - first)
+        chunk = synthetic_chunk(rng, 100_000 + first, rows, size,
+                                rows_per_user, months)
+        chunk.to_csv(path, sep='|', index=False, header=first == 0,
+                     mode='w' if first == 0 else 'a')
+        rows += len(chunk)
+    return rows
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    rows = write_synthetic(args.path, args.users, args.rows_per_user,
+                           args.months, args.seed)
+    print(f'Wrote {rows:,} rows of {args.users:,} users to {args.path}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
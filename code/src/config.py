@@ -10,7 +10,10 @@ OUTDIR = os.path.join(ROOTDIR, 'output')
 FIGDIR = os.path.join(OUTDIR, 'figures')
 TABDIR = os.path.join(OUTDIR, 'tables')
 MODELDIR = os.path.join(CODEDIR, 'models')
+CACHEDIR = os.path.join(TEMPDIR, 'cache')
 
 
 # globals
 TAGVAR = 'up_tag'
+NUM_PARTS = 16
+CACHE_MAX_BYTES = 20 * 2**30
@@ -1,19 +1,127 @@
 import numpy as np
+import pandas as pd
 
 
-def latest_balance_as_row(df):
-    """Add latest balance as a temporary row.
+def balance_rows(df):
+    """Return latest balance of each account as a transaction row.
 
     Data dict notes that exact zero values result from unsuccessful
     account refreshes, so they are treated as missing.
     """
     cols = ['account_id', 'account_last_refreshed', 'latest_balance']
     data = df[cols].drop_duplicates().copy()
+    data['account_last_refreshed'] = (data.account_last_refreshed
+                                      .astype('datetime64[ns]'))
     data['latest_balance'] = data.latest_balance.replace(0, np.nan)
     data['transaction_description'] = '_balance'
-    data = data.rename(columns={'account_last_refreshed': 'transaction_date',
+    return data.rename(columns={'account_last_refreshed': 'transaction_date',
                                 'latest_balance': 'amount'})
-    return df.append(data).sort_values(['account_id', 'transaction_date'])
+
+
+def latest_balance_as_row(df):
+    """Add latest balance as a temporary row."""
+    data = balance_rows(df)
+    return pd.concat([df, data]).sort_values(['account_id', 'transaction_date'])
+
+
+def daily_grid(flows):
+    """Expand daily flows to all days between first and last day of segment.
+
+    flows has columns segment, day, and amount, with one row per segment and
+    day. Days without flows get an amount of zero.
+    """
+    g = flows.groupby('segment').day
+    first, last = g.min(), g.max()
+    lengths = (last - first).dt.days.to_numpy() + 1
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    segment = np.repeat(first.index.to_numpy(), lengths)
+    offset = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    day = np.repeat(first.to_numpy(), lengths) + offset * np.timedelta64(1, 'D')
+    amount = np.zeros(len(day))
+    seg_pos = pd.Series(starts, index=first.index)
+    pos = (seg_pos.reindex(flows.segment).to_numpy()
+           + (flows.day - first.reindex(flows.segment).to_numpy())
+           .dt.days.to_numpy())
+    amount[pos] = flows.amount.to_numpy()
+    return pd.DataFrame({'segment': segment, 'day': day, 'amount': amount})
+
+
+def rolling_cumsum(values, segment, window, aggfunc):
+    """Return cumulative sum of rolling aggregates within segments.
+
+    Segments have to be contiguous and increasing.
+    """
+    rolled = (pd.Series(values)
+              .groupby(segment)
+              .rolling(window=window, min_periods=1).agg(aggfunc)
+              .to_numpy())
+    return pd.Series(rolled).groupby(segment).cumsum().to_numpy()
+
+
+def daily_balances(df, window=3, aggfunc='mean', start=None, end=None):
+    """Return daily balances of all accounts.
+
+    Balances before the day of the latest refresh are calculated backwards
+    from the latest balance, balances from that day onwards forwards, and
+    daily flows are smoothed with rolling window before cumulating. All
+    accounts are processed at once on a sorted (account, day) grid.
+    Balances can be restricted to days between start and end.
+    """
+    cols = ['account_id', 'transaction_date', 'amount']
+    data = pd.concat([df[cols], balance_rows(df)[cols]], ignore_index=True)
+    data['day'] = data.transaction_date.dt.normalize()
+
+    refresh = (balance_rows(df)
+               .sort_values(['account_id', 'transaction_date'])
+               .drop_duplicates('account_id')
+               .set_index('account_id'))
+    refresh_day = refresh.transaction_date.dt.normalize()
+    latest = refresh.amount
+    data['pre'] = (data.day < refresh_day.reindex(data.account_id)
+                   .to_numpy())
+
+    flows = (data.groupby(['account_id', 'pre', 'day'])
+             .amount.sum().reset_index())
+    segments = flows[['account_id', 'pre']].drop_duplicates()
+    segments = segments.reset_index(drop=True).rename_axis('segment')
+    flows = flows.merge(segments.reset_index(), on=['account_id', 'pre'])
+    grid = daily_grid(flows[['segment', 'day', 'amount']])
+    grid = grid.merge(segments.reset_index(), on='segment')
+
+    post = grid[~grid.pre]
+    post_balance = rolling_cumsum(post.amount.mul(-1).to_numpy(),
+                                  post.segment.to_numpy(), window, aggfunc)
+    pre = grid[grid.pre].iloc[::-1]
+    pre_segment = pre.segment.max() - pre.segment.to_numpy()
+    pre_balance = (rolling_cumsum(pre.amount.to_numpy(), pre_segment,
+                                  window, aggfunc)
+                   + latest.reindex(pre.account_id).to_numpy())
+
+    balances = pd.concat([
+        pd.DataFrame({'account_id': pre.account_id.to_numpy(),
+                      'transaction_date': pre.day.to_numpy(),
+                      'balance': pre_balance}),
+        pd.DataFrame({'account_id': post.account_id.to_numpy(),
+                      'transaction_date': post.day.to_numpy(),
+                      'balance': post_balance}),
+    ])
+    if start is not None:
+        balances = balances[balances.transaction_date >= start]
+    if end is not None:
+        balances = balances[balances.transaction_date <= end]
+    return (balances
+            .sort_values(['account_id', 'transaction_date'])
+            .reset_index(drop=True))
+
+
+def iter_balances(df, start=None, end=None, chunksize=10_000, **kwargs):
+    """Yield daily balances between start and end for chunks of accounts.
+
+    Only one chunk of balances is held in memory at a time.
+    """
+    codes, _ = pd.factorize(df.account_id, sort=True)
+    for _, chunk in df.groupby(codes // chunksize):
+        yield daily_balances(chunk, start=start, end=end, **kwargs)
 
 
 def calc_balances(df, window=3, aggfunc='mean'):
@@ -22,34 +130,5 @@ def calc_balances(df, window=3, aggfunc='mean'):
     Default calculates balance for each day as the mean of the balances of
     the current day and the two subsequent days.
     """
-    def helper(g):
-        mask = g.transaction_description.eq('_balance')
-        latest_balance = g[mask].amount.values[0]
-        refresh_date = g[mask].transaction_date.dt.date.values[0]
-        pre_refresh = g.transaction_date.dt.date < refresh_date
-        pre_refresh_balances = (
-            g[pre_refresh]
-            .set_index('transaction_date')
-            .resample('D').amount.sum()
-            .sort_index(ascending=False)
-            .rolling(window=window, min_periods=1).agg(aggfunc)
-            .cumsum()
-            .add(latest_balance)
-        )
-        post_refresh_balances = (
-            g[~pre_refresh]
-            .set_index('transaction_date')
-            .resample('D').amount.sum().mul(-1)
-            .sort_index(ascending=True)
-            .rolling(window=window, min_periods=1).agg(aggfunc)
-            .cumsum()
-        )
-        return (
-            pre_refresh_balances
-            .append(post_refresh_balances)
-            .sort_index()
-            .rename('balance')
-        )
-    data = latest_balance_as_row(df)
-    balances = data.groupby('account_id').apply(helper).reset_index()
+    balances = daily_balances(df, window, aggfunc)
     return df.merge(balances, how='left', validate='m:1')
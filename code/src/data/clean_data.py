@@ -1,8 +1,66 @@
+import contextlib
+import re
 import numpy as np
 import pandas as pd
 from src import config
+from src.helpers.helpers import map_unique
+from src.helpers.profiling import profiled
+from .dtypes import tag_dtype, set_tag_dtype, empty_column, compact
+
+
+TFR_RE = re.compile('|'.join([' ft', ' trf', 'xfer', 'transfer']))
+TFR_EXCLUDE_RE = re.compile('|'.join(['fee', 'interest']))
+CARD_REPAYMENT_RE = re.compile('|'.join([
+    'credit card repayment', 'credit card payment', 'credit card'
+]))
+INCOMES = {
+    'earnings': [
+        'salary or wages - main',
+        'salary or wages - other',
+        'salary - secondary',
+    ],
+    'pensions': [
+        'pension - other',
+        'pension',
+        'work pension',
+        'state pension',
+        'pension or investments',
+    ],
+    'benefits': [
+        'benefits',
+        'family benefits',
+        'job seekers benefits',
+        'other benefits',
+        'incapacity benefits'
+    ],
+    'other': [
+        'rental income - whole property',
+        'rental income - room',
+        'rental income',
+        'irregular income or gifts',
+        'miscellaneous income - other',
+        'investment income - other',
+        'loan or credit income',
+        'bond income',
+        'interest income',
+        'dividend',
+    ],
+}
+INCOME_RES = {type: re.compile('|'.join(tags))
+              for type, tags in INCOMES.items()}
+DERIVED_TAGS = ['transfers'] + [type + '_income' for type in INCOMES]
+
+
+def copy_frame(df):
+    """Return copy of df that steps can modify.
+
+    Under copy-on-write a shallow copy suffices, since columns are only
+    copied once they are modified.
+    """
+    return df.copy(deep=not pd.get_option('mode.copy_on_write'))
 
 
+@profiled
 def drop_last_month(df):
     """Drop last month, which might have missing data.
     For first month, Jan 2012, we have complete data.
@@ -11,35 +69,62 @@ def drop_last_month(df):
     return df[ym < ym.max()]
 
 
+@profiled
 def clean_categoricals(df: pd.DataFrame):
-    """Strip categorical values and convert to lowercase."""
+    """Strip categorical text values and convert to lowercase.
+
+    Categories of other values, such as static dates, are left as they are.
+    """
     def helper(col):
-        return col.astype(str).str.lower().str.strip().astype('category')
-    df = df.copy()
-    cols = df.select_dtypes('category')
-    df[cols.columns] = cols.apply(helper)
+        return map_unique(col, lambda s: s.astype(str).str.lower().str.strip(),
+                          categorical=True)
+    df = copy_frame(df)
+    cols = [col for col, dtype in df.dtypes.items()
+            if isinstance(dtype, pd.CategoricalDtype)
+            and dtype.categories.dtype == object]
+    df[cols] = df[cols].apply(helper)
     return df
 
 
+@profiled
+def compact_columns(df):
+    """Store text columns and static dates as categories.
+
+    read_raw returns compact columns already, so this only converts
+    frames from other sources.
+    """
+    return compact(df)
+
+
+@profiled
 def clean_tags(df):
-    """Replace parenthesis with dash for save regex searches."""
-    df = df.copy()
+    """Replace parenthesis with dash for save regex searches.
+
+    Tag columns share one categorical dtype, which includes the tags
+    assigned during cleaning.
+    """
+    def helper(s):
+        return (s.str.replace('(', '- ', regex=False)
+                .str.replace(')', '', regex=False))
+    df = copy_frame(df)
     for tag in ['up_tag', 'auto_tag', 'manual_tag']:
-        df[tag] = df[tag].str.replace('(', '- ').str.replace(')', '')
-    return df
+        df[tag] = map_unique(df[tag], helper, categorical=True)
+    return set_tag_dtype(df, tag_dtype(df, DERIVED_TAGS))
 
 
+@profiled
 def clean_gender(df):
     """Categorise 'u' as missing."""
-    df = df.copy()
+    df = copy_frame(df)
     transformed = df.gender.astype('str').replace('u', None)
     df['gender'] = transformed.astype('category')
     return df
 
 
+@profiled
 def order_salaries(df):
     """Turn salary range into ordered variable."""
-    df = df.copy()
+    df = copy_frame(df)
     cats = ['< 10k', '10k to 20k', '20k to 30k',
             '30k to 40k', '40k to 50k', '50k to 60k',
             '60k to 70k', '70k to 80k', '> 80k']
@@ -56,23 +141,26 @@ def drop_business_accounts(df):
     pass
 
 
+@profiled
 def correct_up_tag(df):
     """Make up_tag equal manual tag if it exists and auto_tag otherwise.
     This is how auto tag is supposed to behave but doesn't always.
     """
-    df = df.copy()
-    df['up_tag'] = np.where(df.manual_tag.ne('no tag'),
-                            df.manual_tag, df.auto_tag)
+    df = copy_frame(df)
+    df['up_tag'] = df.manual_tag.where(df.manual_tag.ne('no tag'),
+                                       df.auto_tag)
     return df
 
 
+@profiled
 def add_tag(df):
     """Create empty corrected tag variable."""
-    df = df.copy()
-    df['tag'] = None
+    df = copy_frame(df)
+    df['tag'] = empty_column(df, df.auto_tag.dtype)
     return df
 
 
+@profiled
 def tag_pmt_pairs(df, knn=5):
     """Tag payments from one account to another as transfers.
 
@@ -90,41 +178,73 @@ def tag_pmt_pairs(df, knn=5):
 
     Code sorts data by user, amount, and transaction date, and checks for each
     txn and each of its k nearest preceeding neighbours whether, together, they
-    meet the above criteria.
+    meet the above criteria. Set knn to None to check all neighbours.
+
+    Only candidate txns, those in a (user, amount) group of more than one
+    txn above GBP50, are checked. Dates within a group are sorted, so a
+    candidate whose k-th neighbour is outside its group or 3 or more days
+    earlier cannot pair at any larger distance and is dropped. Checking
+    stops once no candidates remain, so the cost grows with the number of
+    pairs within 2 days rather than with the square of group sizes.
     """
-    df = df.copy()
+    df = copy_frame(df)
     df['amount'] = df.amount.abs()
     df = df.sort_values(['user_id', 'amount', 'transaction_date'])
-    for k in range(1, knn+1):
+
+    user = df.user_id.to_numpy()
+    amount = df.amount.to_numpy()
+    new_group = (user[1:] != user[:-1]) | (amount[1:] != amount[:-1])
+    group = np.concatenate([[0], np.cumsum(new_group)])
+    group_size = np.bincount(group)[group]
+    cands = np.flatnonzero((amount > 50) & (group_size > 1))
+
+    date = df.transaction_date.to_numpy()
+    sign = df.credit_debit.astype('category').cat.codes.to_numpy()
+    is_tagged = df.tag.eq('transfers').to_numpy()
+    is_tfr_row = np.zeros(len(df), dtype=bool)
+
+    k = 0
+    while cands.size and (knn is None or k < knn):
+        k += 1
+        prev = np.maximum(cands - k, 0)
+        days = date[cands] - date[prev]
+        in_reach = (
+            (cands >= k)
+            & (group[cands] == group[prev])
+            & ~np.isnat(days)
+            & (days < np.timedelta64(3, 'D'))
+        )
+        cands, prev = cands[in_reach], prev[in_reach]
         is_tfr = (
-            (df.user_id == df.user_id.shift(k))
-            & (df.amount > 50)
-            & (df.amount == df.amount.shift(k))
-            & (df.transaction_date.diff(k).dt.days <= 2)
-            & (df.credit_debit != df.credit_debit.shift(k))
-            & (df.tag.ne('transfers'))                       # <1>
-            & (df.tag.shift(k).ne('transfers'))              # <1>
+            (sign[cands] != sign[prev])
+            & ~is_tagged[cands]                              # <1>
+            & ~is_tagged[prev]                               # <1>
         )
         # tag first txn of pair
-        mask = is_tfr.eq(True) & is_tfr.shift(k).eq(False)   # <2>
-        df['tag'] = np.where(mask, 'transfers', df.tag)
+        is_tfr_row[cands] = is_tfr
+        mask = is_tfr & ~is_tfr_row[prev]                    # <2>
+        is_tfr_row[cands] = False
+        is_tagged[cands[mask]] = True
         # tag second txn of pair
-        mask = is_tfr.shift(-k).eq(True)
-        df['tag'] = np.where(mask, 'transfers', df.tag)
+        is_tagged[prev[is_tfr]] = True
+
+    df['tag'] = df.tag.mask(is_tagged, 'transfers')
     return df
 
 
+@profiled
 def tag_tranfsers(df):
     """Tag txns with description indicating tranfser payment."""
-    df = df.copy()
-    tfr_strings = [' ft', ' trf', 'xfer', 'transfer']
-    exclude = ['fee', 'interest']
-    mask = (df.transaction_description.str.contains('|'.join(tfr_strings))
-            & ~df.transaction_description.str.contains('|'.join(exclude)))
+    def helper(s):
+        return (s.str.contains(TFR_RE, na=False)
+                & ~s.str.contains(TFR_EXCLUDE_RE, na=False))
+    df = copy_frame(df)
+    mask = map_unique(df.transaction_description, helper).astype(bool)
     df.loc[mask, 'tag'] = 'transfers'
     return df
 
 
+@profiled
 def drop_untagged(df):
     """Drop untagged transactions."""
     mask = (df.up_tag.eq('no tag')
@@ -133,85 +253,61 @@ def drop_untagged(df):
     return df[~mask]
 
 
+@profiled
 def tag_incomes(df):
     """Tag earnings, pensions, benefits, and other income.
     Based on Appendix A in Haciouglu et al. (2020).
     """
-    df = df.copy()
-    incomes = {
-        'earnings': [
-            'salary or wages - main',
-            'salary or wages - other',
-            'salary - secondary',
-        ],
-        'pensions': [
-            'pension - other',
-            'pension',
-            'work pension',
-            'state pension',
-            'pension or investments',
-        ],
-        'benefits': [
-            'benefits',
-            'family benefits',
-            'job seekers benefits',
-            'other benefits',
-            'incapacity benefits'
-        ],
-        'other': [
-            'rental income - whole property',
-            'rental income - room',
-            'rental income',
-            'irregular income or gifts',
-            'miscellaneous income - other',
-            'investment income - other',
-            'loan or credit income',
-            'bond income',
-            'interest income',
-            'dividend',
-        ],
-    }
-    for type, tags in incomes.items():
-        mask = (df[config.TAGVAR].str.match('|'.join(tags))
-                & df.credit_debit.eq('credit'))
-        df.loc[mask, 'tag'] = type + '_income'
+    def helper(s):
+        types = pd.Series(None, index=s.index, dtype=object)
+        for type, regex in INCOME_RES.items():
+            types[s.str.match(regex, na=False)] = type + '_income'
+        return types
+    df = copy_frame(df)
+    types = map_unique(df[config.TAGVAR], helper)
+    mask = types.notna() & df.credit_debit.eq('credit')
+    df.loc[mask, 'tag'] = types[mask]
     return df
 
 
+@profiled
 def fill_tag(df):
     """Replace tag with auto tag if missing."""
-    df = df.copy()
+    df = copy_frame(df)
     df['tag'] = df.tag.where(df.tag.notna(), df.auto_tag).astype('category')
     return df
 
 
 def drop_card_repayments(df):
     """Drop card repayment transactions from current accounts."""
-    tags = ['credit card repayment', 'credit card payment', 'credit card']
-    mask = (df.auto_tag.str.contains('|'.join(tags))
-            & df.account_type.eq('current'))
+    is_repayment = map_unique(
+        df.auto_tag, lambda s: s.str.contains(CARD_REPAYMENT_RE, na=False))
+    mask = is_repayment.astype(bool) & df.account_type.eq('current')
     return df[~mask]
 
 
+@profiled
 def sign_amount(df):
     """Make credits negative."""
-    df = df.copy()
+    df = copy_frame(df)
     credit = df.credit_debit.eq('credit')
     df['amount'] = np.where(credit, df.amount.mul(-1), df.amount)
     return df
 
 
+@profiled
 def reorder_columns(df):
     first = [
         'user_id', 'transaction_date', 'amount',
         'transaction_description', 'merchant_name',
         'auto_tag', 'tag', 'manual_tag'
     ]
-    rest = set(df.columns) - set(first)
-    ordered = first + list(rest)
+    rest = [col for col in df.columns if col not in first]
+    ordered = first + rest
     return df[ordered]
 
 
+@profiled
 def drop_unneeded_columns(df):
     cols = [
         'msoa',
@@ -223,16 +319,33 @@ def drop_unneeded_columns(df):
     return df.drop(cols, axis=1)
 
 
+@profiled
 def sort_rows(df):
     return df.sort_values(['user_id', 'transaction_date'], ignore_index=True)
 
 
-def clean_data(df):
-    """Perform simple cleaning operations required for selection."""
+def clean_data(df, copy=True):
+    """Perform simple cleaning operations required for selection.
+
+    With copy set to False, steps run under copy-on-write, so they no longer
+    copy the full frame before modifying it. The input frame is never
+    modified, as the first step returns a new frame.
+    """
+    if copy:
+        context = contextlib.nullcontext()
+    else:
+        context = pd.option_context('mode.copy_on_write', True)
+    with context:
+        return _clean_data(df)
+
+
+def _clean_data(df):
     return (
         df
+        .pipe(drop_unneeded_columns)
         .pipe(drop_last_month)
         .pipe(clean_categoricals)
+        .pipe(compact_columns)
         .pipe(clean_tags)
         .pipe(clean_gender)
         .pipe(order_salaries)
@@ -245,6 +358,5 @@ def clean_data(df):
         .pipe(drop_untagged)
         .pipe(sign_amount)
         .pipe(reorder_columns)
-        .pipe(drop_unneeded_columns)
         .pipe(sort_rows)
     )
@@ -1,6 +1,9 @@
+from contextlib import contextmanager
 from functools import wraps
 from collections import Counter, OrderedDict
 import re
+import weakref
+import pandas as pd
 
 
 class OrderedCounter(Counter, OrderedDict):
@@ -13,7 +16,83 @@ class OrderedCounter(Counter, OrderedDict):
         return self.__class__, (OrderedDict(self),)
 
 
+class SampleCounts:
+    """Per-user aggregates of the sample at the latest counted step.
+
+    Steps that drop whole users through keep_users update the aggregates
+    from the kept users instead of recounting the full frame. Counts of
+    accounts assume that accounts are not shared between users.
+    """
+
+    def __init__(self):
+        self.users = None
+        self.paused = False
+        self._frame = None
+
+    def is_current(self, df):
+        """Return True if aggregates describe df."""
+        return self._frame is not None and self._frame() is df
+
+    def track(self, df):
+        self._frame = weakref.ref(df)
+
+    def reset(self, df):
+        """Aggregate df by user."""
+        g = df.groupby('user_id')
+        self.users = pd.DataFrame({
+            'accs': g.account_id.nunique(),
+            'txns': g.size(),
+            'value': g.amount.sum().astype('float64'),
+        })
+        self.track(df)
+
+    def keep(self, users):
+        self.users = self.users[self.users.index.isin(users)]
+
+    def totals(self):
+        return {
+            'users': len(self.users),
+            'accs': self.users.accs.sum(),
+            'txns': self.users.txns.sum(),
+            'value': self.users.value.sum() / 1e6,
+        }
+
+
 count = OrderedCounter()
+sample = SampleCounts()
+
+
+@contextmanager
+def paused():
+    """Suspend counting, to apply selection criteria outside of the sample."""
+    sample.paused = True
+    try:
+        yield
+    finally:
+        sample.paused = False
+
+
+def update_count(df, step):
+    """Add counts of df at step, recounting only if df is untracked."""
+    if sample.paused:
+        return
+    if not sample.is_current(df):
+        sample.reset(df)
+    count.update({step + '@' + k: v for k, v in sample.totals().items()})
+
+
+def keep_users(df, users):
+    """Keep transactions of users.
+
+    If df is the latest counted frame, its counts are updated from the
+    per-user aggregates of the kept users.
+    """
+    is_current = sample.is_current(df)
+    df = df[df.user_id.isin(users)]
+    if is_current:
+        sample.keep(users)
+        sample.track(df)
+    return df
 
 
 def counter(func):
@@ -24,22 +103,12 @@ def counter(func):
     def wrapper(*args, **kwargs):
         df = func(*args, **kwargs)
         docstr = re.match('[^\n]*', func.__doc__).group()
-        count.update({
-            docstr + '@users': df.user_id.nunique(),
-            docstr + '@accs': df.account_id.nunique(),
-            docstr + '@txns': len(df),
-            docstr + '@value': df.amount.sum() / 1e6
-        })
+        update_count(df, docstr)
         return df
     return wrapper
 
 
 def add_count(df, step):
     """Count sample at step in pipeline."""
-    count.update({
-        step + '@users': df.user_id.nunique(),
-        step + '@accs': df.account_id.nunique(),
-        step + '@txns': len(df),
-        step + '@value': df.amount.sum() / 1e6
-    })
+    update_count(df, step)
     return df
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+TAG_COLUMNS = ['up_tag', 'auto_tag', 'manual_tag', 'tag']
+
+# Dates that take one value per user or account, stored as categories
+STATIC_DATES = ['user_registration_date', 'account_created',
+                'account_last_refreshed']
+
+
+def tag_dtype(df, derived=()):
+    """Return categorical dtype shared by all tag columns of df.
+
+    Categories are those of the tag columns in df plus derived tags that
+    cleaning assigns, so that tags of different columns can be compared
+    and combined without converting them to strings.
+    """
+    tags = set(derived)
+    for col in TAG_COLUMNS:
+        if col in df:
+            tags.update(df[col].dropna().unique())
+    return pd.CategoricalDtype(sorted(tags))
+
+
+def set_tag_dtype(df, dtype):
+    """Convert tag columns of df to dtype in place."""
+    for col in TAG_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def empty_column(df, dtype):
+    """Return categorical column of missing values."""
+    codes = np.full(len(df), -1, dtype='int8')
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype),
+                     index=df.index)
+
+
+def compact(df):
+    """Return df with columns in compact dtypes.
+
+    Text columns become categorical and static dates are stored as
+    categories, which need 1 to 4 bytes per row instead of 8.
+    """
+    df = df.copy(deep=False)
+    for col in df.select_dtypes('object'):
+        df[col] = df[col].astype('category')
+    for col in STATIC_DATES:
+        if col in df and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def concat_frames(frames):
+    """Concatenate frames, keeping categorical columns categorical.
+
+    pd.concat turns categoricals with different categories into objects,
+    so categories are unioned first.
+    """
+    frames = [f for f in frames if f is not None]
+    df = pd.concat(frames, ignore_index=True)
+    for col, dtype in frames[-1].dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            values = union_categoricals([f[col].astype('category')
+                                         for f in frames],
+                                        ignore_order=True)
+            if dtype.ordered:
+                values = values.set_categories(dtype.categories,
+                                               ordered=True)
+            df[col] = values
+    return df
+
+
+def footprint(df):
+    """Return memory of each column of df in bytes, including strings."""
+    return df.memory_usage(index=False, deep=True)
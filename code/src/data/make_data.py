@@ -2,12 +2,20 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import multiprocessing
 import os
+import shutil
 import sys
 import tempfile
+import numpy as np
 import pandas as pd
 from src import config
 from src.helpers.helpers import export_latex_table
+from src.helpers.cache import StageCache, hash_values
+from src.helpers.profiling import profile
+from src.data.read_raw import cache_dir, cached_pieces, mark_cached
+from src.data.split_file import user_partitions
+from src.data.write_data import bucket_dir, record_parts, write_frame
 from src.data import (
     count,
     split_file,
@@ -21,33 +29,146 @@ from src.data import (
 def parse_args(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('sample')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--engine', choices=['pandas', 'arrow'],
+                        default='pandas')
+    parser.add_argument('--cache', action='store_true')
+    parser.add_argument('--no-copy', dest='copy', action='store_false')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--trace', action='store_true')
     return parser.parse_args()
 
 
-def make_data(sample):
-    """Produce clean dataset."""
+def remove(path):
+    """Remove file or directory if it exists."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def make_piece(piece, read_kws, copy=True):
+    """Read and clean piece and select sample.
+
+    With cache, cleaned and selected pieces are taken from the stage cache
+    unless the raw file or the code of the stage has changed.
+    """
+    if not read_kws['cache']:
+        return (
+            read_raw(piece, **read_kws)
+            .pipe(clean_data, copy=copy)
+            .pipe(select_sample)
+        )
+    stages = [(clean_data, {'copy': copy}), (select_sample, {})]
+    raw_key = os.path.basename(cache_dir(read_kws['source'],
+                                         read_kws['engine']))
+    input_key = hash_values(raw_key, os.path.basename(piece))
+    return StageCache().run_stages(stages, input_key,
+                                   lambda: read_raw(piece, **read_kws))
+
+
+def write_piece(df, piece, outdir, num_parts=None):
+    """Write clean piece to its user bucket of dataset and return users.
+
+    Pieces are named after the partition of their users, which is thus
+    their bucket. Raises ValueError if a user's bucket by user_partitions,
+    by which readers look users up, is not that of the piece.
+    """
+    if num_parts is None:
+        num_parts = config.NUM_PARTS
+    bucket = int(os.path.splitext(os.path.basename(piece))[0])
+    buckets = user_partitions(df.user_id.to_numpy(), num_parts)
+    if (buckets != bucket).any():
+        users = df.user_id[buckets != bucket].unique()
+        raise ValueError(f'Piece {os.path.basename(piece)} has users of '
+                         f'other buckets: {users[:5].tolist()}')
+    write_frame(df, os.path.join(bucket_dir(outdir, bucket), 'base.parquet'))
+    return df.user_id.unique()
+
+
+def process_piece(piece, outdir, read_kws, copy=True):
+    """Make piece and write result to dataset directory.
+
+    Runs in a worker process, so the selection counts and the profile of
+    the piece are collected afresh and returned together with the piece's
+    users.
+    """
+    count.clear()
+    profile.clear()
+    clean_piece = make_piece(piece, read_kws, copy)
+    users = write_piece(clean_piece, piece, outdir)
+    return os.path.basename(piece), count.copy(), profile.records, users
+
+
+def _process_piece(args):
+    return process_piece(*args)
+
+
+def write_dataset(raw_pieces, path, workers, read_kws, copy=True):
+    """Process pieces in a process pool and write bucketed dataset.
+
+    Counts and profiles of all pieces are merged into the global count and
+    profile. Returns users.
+    """
+    os.makedirs(path)
+    tasks = [(piece, path, read_kws, copy) for piece in raw_pieces]
+    users = []
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.imap_unordered(_process_piece, tasks)
+        for name, piece_count, piece_records, piece_users in results:
+            print(name)
+            count.update(piece_count)
+            profile.records.extend(piece_records)
+            users.append(piece_users)
+    return np.concatenate(users)
+
+
+def make_data(sample, workers=1, engine='pandas', cache=False, copy=True):
+    """Produce clean dataset.
+
+    Clean data is a parquet dataset with one directory per user bucket,
+    which records the number of buckets once all are written. Each piece
+    is written to its bucket as soon as it is processed, so only one
+    piece is held in memory at a time. With more than one worker, pieces
+    are processed in parallel.
+    With cache, raw pieces are cached in columnar format under the key of
+    the raw file, and splitting is skipped while the raw file, the engine,
+    the number of pieces, and the reader code are unchanged.
+    Cleaned and selected pieces are cached as well.
+    Without copy, clean_data runs without defensive copies.
+    """
     with tempfile.TemporaryDirectory() as tempdir:
         fp = os.path.join(config.TEMPDIR, f'data_{sample}.csv')
-        print('Splitting data...')
-        split_file(fp, tempdir)
-        raw_pieces = (f.path for f in os.scandir(tempdir)
-                      if f.name.endswith('.csv'))
-        clean_pieces = []
-        for piece in raw_pieces:
-            print(os.path.basename(piece))
-            clean_piece = (
-                read_raw(piece)
-                .pipe(clean_data)
-                .pipe(select_sample)
-            )
-            clean_pieces.append(clean_piece)
+        read_kws = dict(engine=engine, cache=cache, source=fp)
+        cached = cached_pieces(fp, engine) if cache else []
+        if cached:
+            print('Reading cached pieces...')
+            raw_pieces = [os.path.join(tempdir, name) for name in cached]
+        else:
+            print('Splitting data...')
+            split_file(fp, tempdir, config.NUM_PARTS)
+            raw_pieces = sorted(f.path for f in os.scandir(tempdir)
+                                if f.name.endswith('.csv'))
         clean_name = f'data_{sample}.parquet'
         clean_path = os.path.join(config.TEMPDIR, clean_name)
-        clean = pd.concat(clean_pieces)
-        clean.to_parquet(clean_path)
+        remove(clean_path)
+        if workers > 1:
+            users = write_dataset(raw_pieces, clean_path, workers, read_kws,
+                                  copy)
+        else:
+            users = []
+            for piece in raw_pieces:
+                print(os.path.basename(piece))
+                clean_piece = make_piece(piece, read_kws, copy)
+                users.append(write_piece(clean_piece, piece, clean_path))
+                del clean_piece
+            users = np.concatenate(users)
+        record_parts(clean_path, config.NUM_PARTS)
+        if cache:
+            mark_cached(fp, engine)
         users_name = f'users_{sample}.csv'
         users_path = os.path.join(config.DATADIR, users_name)
-        users = pd.Series(sorted(clean.user_id.unique()))
+        users = pd.Series(sorted(users), name='user_id')
         users.to_csv(users_path, index=False)
 
 
@@ -55,11 +176,15 @@ def main(argv=None):
     if argv is None:
         argv = sys.argv[:1]
     args = parse_args(argv)
-    make_data(args.sample)
+    if args.profile or args.trace:
+        profile.enable(args.trace)
+    make_data(args.sample, args.workers, args.engine, args.cache, args.copy)
     tbl = selection_table(count)
     tbl_name = f'sample_selection_{args.sample}.tex'
     export_latex_table(tbl, name=tbl_name, column_format='lrrrr')
     print(tbl)
+    if profile.enabled:
+        print(profile.export(f'data_{args.sample}', config.TABDIR))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+import functools
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from src import config
+from src.helpers.profiling import profiled
+from .split_file import user_partitions
+from .write_data import bucket_dir, read_parts
+
+
+# Default number of users per chunk of chunked reads
+CHUNK_USERS = 5_000
+
+
+def data_path(sample):
+    """Return path of clean dataset of sample."""
+    return os.path.join(config.TEMPDIR, f'data_{sample}.parquet')
+
+
+def users_path(sample):
+    """Return path of file listing users in sample."""
+    return os.path.join(config.DATADIR, f'users_{sample}.csv')
+
+
+def sample_users(sample):
+    """Return users in sample."""
+    return pd.read_csv(users_path(sample)).user_id
+
+
+def bucket_dirs(path):
+    """Return user bucket directories of dataset at path."""
+    return sorted(f.path for f in os.scandir(path)
+                  if f.is_dir() and f.name.startswith('bucket-'))
+
+
+def parquet_files(path):
+    """Return parquet files in directory."""
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if name.endswith('.parquet')]
+
+
+def dataset_parts(path):
+    """Return number of user buckets of dataset at path.
+
+    Users are looked up in buckets by config.NUM_PARTS, so raises
+    ValueError if the dataset does not record that same number, rather
+    than reading the wrong buckets and dropping users.
+    """
+    num_parts = read_parts(path)
+    if num_parts != config.NUM_PARTS:
+        raise ValueError(f'Dataset at {path} has {num_parts} buckets but '
+                         f'NUM_PARTS is {config.NUM_PARTS}; rerun make_data.')
+    return num_parts
+
+
+def user_files(path, users):
+    """Return parquet files of buckets of users in dataset at path.
+
+    Without users, files of all buckets are returned.
+    """
+    num_parts = dataset_parts(path)
+    dirs = bucket_dirs(path)
+    if len(users):
+        buckets = np.unique(user_partitions(users, num_parts))
+        wanted = {bucket_dir(path, b) for b in buckets}
+        dirs = [d for d in dirs if d in wanted]
+    return [fp for d in dirs for fp in parquet_files(d)]
+
+
+def user_chunks(path, users, size=CHUNK_USERS):
+    """Return users split into chunks of at most size users.
+
+    Users of a chunk are in the same bucket of dataset at path and sorted,
+    so its rows are read from one bucket only and from row groups in its
+    range of users.
+    """
+    users = np.sort(np.asarray(users))
+    buckets = user_partitions(users, dataset_parts(path))
+    chunks = []
+    for bucket in np.unique(buckets):
+        members = users[buckets == bucket]
+        chunks.extend(np.array_split(members, -(-len(members) // size)))
+    return chunks
+
+
+def user_filters(users, filters=None):
+    """Return filters keeping rows of users that meet filters.
+
+    The range of user ids lets the scan skip row groups by their user id
+    statistics before testing membership of each row.
+    """
+    users = np.asarray(users)
+    bounds = ([('user_id', '>=', int(users.min())),
+               ('user_id', '<=', int(users.max()))] if users.size else [])
+    return bounds + [('user_id', 'in', users.tolist())] + list(filters or [])
+
+
+def read_files(files, columns=None, filters=None):
+    """Return columns of rows of parquet files that meet filters.
+
+    Filters are (column, op, value) tuples as in pd.read_parquet, all of
+    which rows must meet. They are applied during the scan, which skips
+    row groups whose statistics rule out matching rows.
+    """
+    dataset = ds.dataset(files, format='parquet')
+    expr = pq.filters_to_expression(filters) if filters else None
+    return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+
+@profiled
+def read_data(sample, columns=None, filters=None, users=None):
+    """Return clean data of users in sample.
+
+    Incremental updates keep the rows of all users in the dataset and
+    define the sample by its users file, so rows are filtered to the
+    users in that file, or to users if given, of whom only the buckets
+    are read. Only columns and rows meeting filters are read.
+    """
+    users = sample_users(sample) if users is None else users
+    files = user_files(data_path(sample), users)
+    return read_files(files, columns, user_filters(users, filters))
+
+
+def read_pieces(sample, columns=None, filters=None):
+    """Yield clean data of users in sample one user bucket at a time.
+
+    Each piece holds all rows of its users, so that per-user calculations
+    on a piece are complete, and memory is bounded by the largest bucket
+    rather than the sample.
+    """
+    users = sample_users(sample)
+    filters = user_filters(users, filters)
+    for path in bucket_dirs(data_path(sample)):
+        yield read_files(parquet_files(path), columns, filters)
+
+
+def chunk_readers(sample, columns=None, filters=None, size=CHUNK_USERS):
+    """Return readers of clean data of users in sample in chunks.
+
+    Each reader is a callable returning all rows of a chunk of at most
+    size users, so chunks can be read independently, and memory is
+    bounded by the size of a chunk rather than the sample.
+    """
+    return [functools.partial(read_data, sample, columns, filters, users)
+            for users in user_chunks(data_path(sample), sample_users(sample),
+                                     size)]
@@ -1,39 +1,151 @@
+import functools
+import glob
+import hashlib
+import os
+import shutil
 import pandas as pd
+from src import config
+from src.helpers.profiling import profiled
+from .dtypes import compact
+
+
+DTYPES = {
+    'Transaction Reference': 'int32',
+    'User Reference': 'int32',
+    'Year of Birth': 'float32',
+    'Salary Range': 'category',
+    'Postcode': 'category',
+    'LSOA': 'category',
+    'MSOA': 'category',
+    'Derived Gender': 'category',
+    'Account Reference': 'int32',
+    'Provider Group Name': 'category',
+    'Account Type': 'category',
+    'Latest Balance': 'float32',
+    'Transaction Description': 'category',
+    'Credit Debit': 'category',
+    'Amount': 'float32',
+    'User Precedence Tag Name': 'category',
+    'Manual Tag Name': 'category',
+    'Auto Purpose Tag Name': 'category',
+    'Merchant Name': 'category',
+    'Merchant Business Line': 'category',
+    'Transaction Updated Flag': 'category',
+}
+
+
+DATES = [
+    'User Registration Date',
+    'Transaction Date',
+    'Account Created Date',
+    'Account Last Refreshed',
+    'Data Warehouse Date Created',
+    'Data Warehouse Date Last Updated',
+]
 
 
 def read(path):
-    dtypes = {
-        'Transaction Reference': 'int32',
-        'User Reference': 'int32',
-        'Year of Birth': 'float32',
-        'Salary Range': 'category',
-        'Postcode': 'category',
-        'LSOA': 'category',
-        'MSOA': 'category',
-        'Derived Gender': 'category',
-        'Account Reference': 'int32',
-        'Provider Group Name': 'category',
-        'Account Type': 'category',
-        'Latest Balance': 'float32',
-        'Transaction Description': 'category',
-        'Credit Debit': 'category',
-        'Amount': 'float32',
-        'User Precedence Tag Name': 'category',
-        'Manual Tag Name': 'category',
-        'Auto Purpose Tag Name': 'category',
-        'Merchant Name': 'category',
-        'Merchant Business Line': 'category',
-        'Transaction Updated Flag': 'category',
+    return pd.read_csv(path, sep='|', parse_dates=DATES, dtype=DTYPES)
+
+
+def read_arrow(path):
+    """Read file with multithreaded Arrow csv reader.
+
+    Uses the same dtypes as read, with categories read as dictionaries.
+    """
+    import pyarrow as pa
+    from pyarrow import csv
+    arrow_types = {
+        'int32': pa.int32(),
+        'float32': pa.float32(),
+        'category': pa.dictionary(pa.int32(), pa.string()),
     }
-    dates = [
-        'User Registration Date',
-        'Transaction Date',
-        'Account Created Date',
-        'Account Last Refreshed',
-        'Data Warehouse Date Created',
-        'Data Warehouse Date Last Updated',
-    ]
-    return pd.read_csv(path, sep='|', parse_dates=dates, dtype=dtypes)
+    types = {col: arrow_types[dtype] for col, dtype in DTYPES.items()}
+    types.update({col: pa.timestamp('ns') for col in DATES})
+    table = csv.read_csv(
+        path,
+        parse_options=csv.ParseOptions(delimiter='|'),
+        convert_options=csv.ConvertOptions(column_types=types,
+                                           strings_can_be_null=True),
+    )
+    return table.to_pandas()
+
+
+READERS = {'pandas': read, 'arrow': read_arrow}
+
+
+@functools.lru_cache(maxsize=None)
+def reader_hash():
+    """Return hash of source code of this module."""
+    with open(__file__, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()[:8]
+
+
+def cache_dir(source, engine='arrow'):
+    """Return cache directory of source file.
+
+    Directory name is keyed on path, size, and modification time of source,
+    and on the engine, the number of pieces source is split into, and the
+    code of this module, so a changed source file or reader never hits an
+    old cache.
+    """
+    stat = os.stat(source)
+    key = hashlib.md5(os.path.abspath(source).encode()).hexdigest()[:8]
+    version = hashlib.md5(f'{engine}-{config.NUM_PARTS}-{reader_hash()}'
+                          .encode()).hexdigest()[:8]
+    return os.path.join(config.CACHEDIR, f'{key}-{stat.st_size}-'
+                                         f'{stat.st_mtime_ns}-{version}')
+
+
+def cache_path(path, source=None, engine='arrow'):
+    """Return path of columnar cache for file.
+
+    Pieces split from a larger file can pass that file as source to be
+    cached under its key, since the pieces themselves are recreated on
+    every run.
+    """
+    source = path if source is None else source
+    name = os.path.basename(path) + '.feather'
+    return os.path.join(cache_dir(source, engine), name)
+
+
+def clear_stale(source, engine='arrow'):
+    """Remove caches of earlier versions of source file."""
+    current = cache_dir(source, engine)
+    prefix = os.path.basename(current).split('-')[0]
+    for d in glob.glob(os.path.join(config.CACHEDIR, prefix + '-*')):
+        if d != current:
+            shutil.rmtree(d, ignore_errors=True)
+
+
+def read_cached(path, engine='arrow', source=None):
+    """Read file from columnar cache, creating cache on first read."""
+    fp = cache_path(path, source, engine)
+    if os.path.exists(fp):
+        return pd.read_feather(fp)
+    df = READERS[engine](path)
+    clear_stale(path if source is None else source, engine)
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    tmp = f'{fp}.{os.getpid()}.tmp'
+    df.to_feather(tmp)
+    os.replace(tmp, fp)
+    return df
+
+
+def cached_pieces(source, engine='arrow'):
+    """Return names of pieces of source if all of them have been cached."""
+    d = cache_dir(source, engine)
+    if not os.path.exists(os.path.join(d, '_complete')):
+        return []
+    return sorted(f.name[:-len('.feather')] for f in os.scandir(d)
+                  if f.name.endswith('.feather'))
+
+
+def mark_cached(source, engine='arrow'):
+    """Mark cache of pieces of source as complete."""
+    d = cache_dir(source, engine)
+    if os.path.isdir(d):
+        open(os.path.join(d, '_complete'), 'w').close()
 
 
 def clean_names(df):
@@ -61,9 +173,23 @@ def rename(df):
     return df.rename(columns=new_names)
 
 
-def read_raw(path):
+@profiled
+def read_raw(path, engine='pandas', cache=False, source=None):
+    """Read raw data file.
+
+    Engine is 'pandas' or 'arrow'. With cache, the typed frame is stored
+    in feather format on first read and loaded from there afterwards.
+    Columns are converted to compact dtypes here, on the frame just read,
+    rather than during cleaning, where under copy-on-write converting a
+    few columns of a shared block keeps the whole old block alive.
+    """
+    if cache:
+        df = read_cached(path, engine, source)
+    else:
+        df = READERS[engine](path)
     return (
-        read(path)
+        df
         .pipe(clean_names)
         .pipe(rename)
+        .pipe(compact)
     )
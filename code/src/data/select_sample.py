@@ -1,88 +1,190 @@
+import numpy as np
 import pandas as pd
-from .counter import counter, add_count
+from src.helpers.helpers import map_unique
+from src.helpers.profiling import profiled
+from .counter import counter, add_count, keep_users
 
 
+def month_index(dates):
+    """Return number of months since year zero."""
+    return dates.dt.year * 12 + dates.dt.month - 1
+
+
+def interior_min(monthly):
+    """Return minimum of monthly values per user, excluding first and last.
+
+    Replicates resampling by month: months without observations between a
+    user's first and last month count as zero. Users with fewer than three
+    months have no interior months and get NaN.
+    """
+    data = monthly.rename('value').reset_index()
+    g = data.groupby('user_id').month
+    first, last = g.transform('min'), g.transform('max')
+    interior = data[(data.month > first) & (data.month < last)]
+    span = g.max() - g.min() - 1
+    num_obs = interior.groupby('user_id').size().reindex(span.index,
+                                                         fill_value=0)
+    mins = interior.groupby('user_id').value.min().reindex(span.index)
+    mins = mins.where(num_obs >= span, np.fmin(mins, 0))
+    return mins.where(span > 0)
+
+
+def yearly_income_range(incomes, first_month):
+    """Return min and max yearly income per user, excluding last year.
+
+    Years start in the month of a user's first transaction. Years without
+    income between a user's first and last income year count as zero.
+    """
+    anchor = first_month.reindex(incomes.user_id).to_numpy() % 12
+    year = (incomes.month.to_numpy() - anchor) // 12
+    yearly = (incomes.assign(year=year)
+              .groupby(['user_id', 'year'])
+              .amount.sum().mul(-1)
+              .rename('value')
+              .reset_index())
+    g = yearly.groupby('user_id').year
+    complete = yearly[yearly.year < g.transform('max')]
+    span = g.max() - g.min()
+    gc = complete.groupby('user_id').value
+    num_obs = gc.size().reindex(span.index, fill_value=0)
+    mins = gc.min().reindex(span.index)
+    maxs = gc.max().reindex(span.index)
+    gaps = num_obs < span
+    mins = mins.where(~gaps, np.fmin(mins, 0))
+    maxs = maxs.where(~gaps, np.fmax(maxs, 0))
+    return pd.DataFrame({'min_income': mins, 'max_income': maxs})
+
+
+def user_months(df):
+    """Return user-month aggregates from which user stats are calculated.
+
+    Aggregates of a month don't change once its data is complete, so
+    incremental updates keep them and only add those of new months.
+    """
+    data = pd.DataFrame({
+        'user_id': df.user_id.to_numpy(),
+        'month': month_index(df.transaction_date).to_numpy(),
+        'account_id': df.account_id.to_numpy(),
+        'amount': df.amount.to_numpy(),
+        'is_current': map_unique(
+            df.account_type,
+            lambda s: s.str.lower().eq('current')).to_numpy(dtype=bool),
+        'is_income': map_unique(
+            df.tag,
+            lambda s: s.str.contains('_income', na=False)
+        ).to_numpy(dtype=bool),
+    })
+    g = data.groupby(['user_id', 'month'])
+    months = pd.DataFrame({
+        'txns': g.size(),
+        'accounts': g.account_id.nunique(),
+        'has_current': g.is_current.any(),
+    })
+    debits = data[data.amount > 0].groupby(['user_id', 'month']).amount
+    months['debits'] = debits.size().reindex(months.index, fill_value=0)
+    months['spend'] = debits.sum().reindex(months.index, fill_value=0)
+    incomes = data[data.is_income].groupby(['user_id', 'month']).amount
+    months['incomes'] = incomes.size().reindex(months.index, fill_value=0)
+    months['income'] = incomes.sum().reindex(months.index, fill_value=0)
+    return months
+
+
+def stats_from_months(months):
+    """Return user stats from user-month aggregates."""
+    g = months.groupby('user_id')
+    stats = pd.DataFrame({
+        'num_months': g.size(),
+        'has_current': g.has_current.any(),
+    })
+    stats['min_txns'] = interior_min(months.txns)
+    stats['max_accounts'] = g.accounts.max()
+    spend = months.spend[months.debits > 0]
+    stats['min_spend'] = interior_min(spend)
+    stats['max_debits'] = spend.groupby('user_id').max()
+    incomes = months[months.incomes > 0].income.rename('amount').reset_index()
+    stats['income_months'] = (incomes.groupby('user_id').size()
+                              .reindex(stats.index, fill_value=0))
+    first_month = months.reset_index('month').groupby('user_id').month.min()
+    income_range = yearly_income_range(incomes, first_month)
+    return stats.join(income_range)
+
+
+@profiled
+def user_stats(df):
+    """Return user-level statistics used by selection criteria.
+
+    Stats only depend on a user's own transactions, so they remain valid
+    as criteria drop whole users.
+    """
+    return stats_from_months(user_months(df))
+
+
+@profiled
 @counter
-def min_number_of_months(df, min_months=6):
+def min_number_of_months(df, min_months=6, stats=None):
     """At least 6 months of data."""
-    def helper(g):
-        num_months = g.transaction_date.dt.to_period('M').nunique()
-        return num_months > min_months
-    return df.groupby('user_id').filter(helper)
+    stats = user_stats(df) if stats is None else stats
+    mask = stats.num_months > min_months
+    return keep_users(df, stats.index[mask])
 
 
+@profiled
 @counter
-def current_account(df):
+def current_account(df, stats=None):
     """At least one current account."""
-    def helper(g):
-        return 'current' in g.account_type.str.lower().unique()
-    return df.groupby('user_id').filter(helper)
+    stats = user_stats(df) if stats is None else stats
+    return keep_users(df, stats.index[stats.has_current])
 
 
+@profiled
 @counter
-def min_txns_and_spend(df, min_txns=5, min_spend=200):
+def min_txns_and_spend(df, min_txns=5, min_spend=200, stats=None):
     """At least 5 transactions and spend of GBP200 per month."""
-    def helper(g):
-        txns = g.resample('M', on='transaction_date').transaction_id.size()
-        debits = g[g.amount > 0]
-        spend = debits.resample('M', on='transaction_date').amount.sum()
-        return txns[1:-1].min() >= min_txns and spend[1:-1].min() >= min_spend
-    return df.groupby('user_id').filter(helper)
+    stats = user_stats(df) if stats is None else stats
+    mask = (stats.min_txns >= min_txns) & (stats.min_spend >= min_spend)
+    return keep_users(df, stats.index[mask])
 
 
+@profiled
 @counter
-def income_pmts(df):
+def income_pmts(df, stats=None):
     """Income payments in 2/3 of all observed months."""
-    def helper(g):
-        tot_months = g.ym.nunique()
-        inc_months = g[g.tag.str.contains('_income')].ym.nunique()
-        return (inc_months / tot_months) > (2/3)
-    data = df[['user_id', 'transaction_date', 'tag']].copy()
-    data['ym'] = data.transaction_date.dt.to_period('M')
-    usrs = data.groupby('user_id').filter(helper).user_id.unique()
-    return df[df.user_id.isin(usrs)]
+    stats = user_stats(df) if stats is None else stats
+    mask = (stats.income_months / stats.num_months) > (2/3)
+    return keep_users(df, stats.index[mask])
 
 
+@profiled
 @counter
-def income_amount(df, lower=5_000, upper=100_000):
+def income_amount(df, lower=5_000, upper=100_000, stats=None):
     """Yearly incomes between 5k and 100k.
 
     Yearly income calculated on rolling basis from first month of data,
     last year excluded as it has probably incomplete data.
     """
-    def helper(g):
-        first_month = g.transaction_date.min().strftime('%b')
-        yearly_freq = 'AS-' + first_month.upper()
-        year = pd.Grouper(freq=yearly_freq, key='transaction_date')
-        yearly_inc = (g[g.tag.str.contains('_income')]
-                      .groupby(year)
-                      .amount.sum().mul(-1))
-        return yearly_inc[:-1].between(lower, upper).all()
-
-    return df.groupby('user_id').filter(helper)
+    stats = user_stats(df) if stats is None else stats
+    mask = (stats.min_income.isna()
+            | ((stats.min_income >= lower) & (stats.max_income <= upper)))
+    return keep_users(df, stats.index[mask])
 
 
+@profiled
 @counter
-def max_accounts(df):
+def max_accounts(df, stats=None):
     """No more than 10 active accounts in any year."""
-    year = pd.Grouper(freq='M', key='transaction_date')
-    usr_max = (df.groupby(['user_id', year]).account_id.nunique()
-               .groupby('user_id').max())
-    users = usr_max[usr_max <= 10].index
-    return df[df.user_id.isin(users)]
+    stats = user_stats(df) if stats is None else stats
+    return keep_users(df, stats.index[stats.max_accounts <= 10])
 
 
+@profiled
 @counter
-def max_debits(df):
+def max_debits(df, stats=None):
     """Debits of no more than 100k in any month."""
-    month = pd.Grouper(freq='M', key='transaction_date')
-    debits = df[df.amount > 0]
-    usr_max = (debits.groupby(['user_id', month]).amount.sum()
-               .groupby('user_id').max())
-    users = usr_max[usr_max <= 100_000].index
-    return df[df.user_id.isin(users)]
+    stats = user_stats(df) if stats is None else stats
+    return keep_users(df, stats.index[stats.max_debits <= 100_000])
 
 
+@profiled
 @counter
 def working_age(df):
     """Working-age."""
@@ -90,17 +192,23 @@ def working_age(df):
     return df[age.between(18, 64)]
 
 
-def select_sample(df):
+def select_sample(df, stats=None):
+    """Apply selection criteria in turn.
+
+    User stats are calculated once, as all criteria but the last drop
+    whole users. Precalculated stats can be passed for the users in df.
+    """
+    stats = user_stats(df) if stats is None else stats
     return (
         df
         .pipe(add_count, 'Raw sample')
-        .pipe(min_number_of_months)
-        .pipe(current_account)
-        .pipe(min_txns_and_spend)
-        .pipe(income_pmts)
-        .pipe(income_amount)
-        .pipe(max_accounts)
-        .pipe(max_debits)
+        .pipe(min_number_of_months, stats=stats)
+        .pipe(current_account, stats=stats)
+        .pipe(min_txns_and_spend, stats=stats)
+        .pipe(income_pmts, stats=stats)
+        .pipe(income_amount, stats=stats)
+        .pipe(max_accounts, stats=stats)
+        .pipe(max_debits, stats=stats)
         .pipe(working_age)
         .pipe(add_count, 'Final sample')
     )
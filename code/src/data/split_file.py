@@ -2,41 +2,184 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import contextlib
+import multiprocessing
 import os
-import re
+import shutil
 import sys
+import time
+import zlib
+import numpy as np
+from src import config
+from src.helpers.profiling import profiled
 
 
 def parse_args(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('path')
     parser.add_argument('tempdir')
+    parser.add_argument('--parts', type=int, default=config.NUM_PARTS)
+    parser.add_argument('--workers', type=int, default=None)
     return parser.parse_args()
 
 
-def split_file(path, tempdir):
-    """Split file into pieces based on first digit of user id."""
-    DIGITS_RE = re.compile(r'\d+')
-    filepaths = {n: os.path.join(tempdir, f'{n}.csv') for n in range(1, 10)}
-    with open(path, 'rt') as source:
-        with contextlib.ExitStack() as stack:
-            files = {n: stack.enter_context(open(fp, 'a'))
-                     for n, fp in filepaths.items()}
-            header = source.readline()
-            for f in files.values():
-                f.write(header)
+def user_field(header, name='User Reference'):
+    """Return position of user id field in header line."""
+    return header.rstrip(b'\r\n').split(b'|').index(name.encode())
+
+
+def user_key(field):
+    """Return raw user id field as decimal digits of the integer id.
+
+    Ids may be quoted, zero-padded, or written as floats, and are only
+    parsed if they are not plain digits already.
+    """
+    field = field.strip()
+    if field.isdigit() and (field[:1] != b'0' or len(field) == 1):
+        return field
+    field = field.strip(b'"')
+    try:
+        user_id = int(field)
+    except ValueError:
+        user_id = int(float(field))
+    return str(user_id).encode()
+
+
+def partition(user_key, num_parts):
+    """Return partition of user id given as decimal digits.
+
+    Uses crc32 rather than the builtin hash, which is salted per process,
+    so a user always lands in the same partition.
+    """
+    return zlib.crc32(user_key) % num_parts
+
+
+def user_partitions(user_ids, num_parts):
+    """Return partition of each integer user id, as assigned when splitting."""
+    users, codes = np.unique(user_ids, return_inverse=True)
+    parts = np.array([partition(str(int(u)).encode(), num_parts)
+                      for u in users], dtype='int64')
+    return parts[codes]
+
+
+def byte_ranges(path, num_chunks):
+    """Split file body into byte ranges that start at line boundaries."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        bounds = [start]
+        for i in range(1, num_chunks):
+            f.seek(max(start, size * i // num_chunks))
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    bounds = sorted(set(bounds))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def split_range(path, start, end, field, num_parts, tempdir, chunk,
+                bufsize=10_000):
+    """Write lines in byte range to chunk files of their partitions.
+
+    Returns number of rows and bytes processed.
+    """
+    buffers = {}
+    files = {}
+    rows = 0
+
+    def flush(part):
+        if part not in files:
+            fp = os.path.join(tempdir, f'{part}.csv.{chunk}')
+            files[part] = open(fp, 'wb')
+        files[part].writelines(buffers.pop(part))
+
+    try:
+        with open(path, 'rb') as source:
+            source.seek(start)
+            pos = start
             for line in source:
-                user_id = DIGITS_RE.findall(line)[1]
-                first_digit = int(user_id[0])
-                files[first_digit].write(line)
+                if pos >= end:
+                    break
+                pos += len(line)
+                key = user_key(line.split(b'|', field + 1)[field])
+                part = partition(key, num_parts)
+                buffers.setdefault(part, []).append(line)
+                if len(buffers[part]) >= bufsize:
+                    flush(part)
+                rows += 1
+        for part in list(buffers):
+            flush(part)
+    finally:
+        for f in files.values():
+            f.close()
+    return rows, end - start
+
+
+def _split_range(args):
+    return split_range(*args)
+
+
+def merge_chunks(tempdir, header, num_parts, num_chunks):
+    """Concatenate chunk files of each partition into one csv file."""
+    for part in range(num_parts):
+        chunks = [os.path.join(tempdir, f'{part}.csv.{chunk}')
+                  for chunk in range(num_chunks)]
+        chunks = [fp for fp in chunks if os.path.exists(fp)]
+        if not chunks:
+            continue
+        with open(os.path.join(tempdir, f'{part}.csv'), 'wb') as target:
+            target.write(header)
+            for fp in chunks:
+                with open(fp, 'rb') as source:
+                    shutil.copyfileobj(source, target)
+                os.remove(fp)
+
+
+@profiled
+def split_file(path, tempdir, num_parts=config.NUM_PARTS, workers=None):
+    """Split file into pieces based on hash of user id.
+
+    Body of file is cut into byte ranges that are processed in parallel,
+    and each row is routed to one of num_parts pieces using only the user
+    id field. Empty pieces are not written. Returns throughput stats.
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    start_time = time.perf_counter()
+    with open(path, 'rb') as f:
+        header = f.readline()
+    field = user_field(header)
+    ranges = byte_ranges(path, workers * 4)
+    tasks = [(path, start, end, field, num_parts, tempdir, chunk)
+             for chunk, (start, end) in enumerate(ranges)]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_split_range, tasks)
+    else:
+        results = [_split_range(task) for task in tasks]
+    merge_chunks(tempdir, header, num_parts, len(ranges))
+
+    rows = sum(r for r, _ in results)
+    nbytes = sum(b for _, b in results)
+    secs = max(time.perf_counter() - start_time, 1e-9)
+    stats = {
+        'rows': rows,
+        'bytes': nbytes,
+        'seconds': secs,
+        'rows_per_sec': rows / secs,
+        'bytes_per_sec': nbytes / secs,
+    }
+    print(f"Split {rows:,} rows into {num_parts} pieces in {secs:,.1f}s "
+          f"({stats['rows_per_sec']:,.0f} rows/s, "
+          f"{stats['bytes_per_sec'] / 1e6:,.1f} MB/s)")
+    return stats
 
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
     args = parse_args(argv)
-    split_file(args.path, args.tempdir)
+    split_file(args.path, args.tempdir, args.parts, args.workers)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,7 @@
 import argparse
-import os
 import sys
 import pandas as pd
-from src import config
+from src.data.read_data import read_pieces
 from src.helpers.helpers import export_latex_table
 
 
@@ -12,20 +11,24 @@ def parse_args(argv):
     return parser.parse_args()
 
 
-def sumstats_table(df, varlist, pctls=None, cols=None):
-    """Produce summary statistics at user level."""
+def user_nunique(pieces, varlist):
+    """Return number of unique values of variables for each user.
+
+    Pieces hold all rows of their users, so counts are calculated one
+    piece at a time.
+    """
+    return pd.concat([df.groupby('user_id')[varlist].nunique()
+                      for df in pieces])
+
+
+def sumstats_table(counts, pctls=None, cols=None):
+    """Produce summary statistics of user-level counts."""
     if pctls is None:
         pctls = [.1, .25, .5, .75, .9]
     if cols is None:
         cols = ['mean', '10%', '25%', '50%', '75%', '90%']
 
-    g = df.groupby('user_id')
-    tbl = pd.DataFrame()
-
-    for var in varlist:
-        stats = g[var].nunique().describe(percentiles=pctls)
-        frame = stats.to_frame().T
-        tbl = tbl.append(frame)
+    tbl = counts.describe(percentiles=pctls).T
     tbl.index = ['Banks', 'Accounts']
     tbl = tbl[cols].reset_index()
     tbl.columns = ['', 'Mean', 'p10', 'p25', 'p50', 'p75', 'p90']
@@ -36,11 +39,9 @@ def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
     args = parse_args(argv)
-    file = f'data_{args.sample}.parquet'
-    path = os.path.join(config.TEMPDIR, file)
-    df = pd.read_parquet(path)
     varlist = ['bank', 'account_id']
-    tbl = sumstats_table(df, varlist)
+    pieces = read_pieces(args.sample, columns=['user_id'] + varlist)
+    tbl = sumstats_table(user_nunique(pieces, varlist))
     export_latex_table(tbl, name='sumstats.tex')
 
 
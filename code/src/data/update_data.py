@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import pandas as pd
+from src import config
+from src.data import read_raw, clean_data, select_sample
+from src.data.counter import paused
+from src.data.dtypes import concat_frames
+from src.helpers.profiling import profile
+from src.data.read_data import (
+    bucket_dirs,
+    data_path,
+    sample_users,
+    users_path,
+)
+from src.data.write_data import write_buckets
+from src.data.select_sample import (
+    month_index,
+    user_months,
+    stats_from_months,
+)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sample')
+    parser.add_argument('drop')
+    parser.add_argument('--engine', choices=['pandas', 'arrow'],
+                        default='pandas')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--trace', action='store_true')
+    return parser.parse_args()
+
+
+def state_path(sample):
+    """Return directory of incremental state of sample.
+
+    State is kept in the dataset it describes, so that replacing the
+    dataset also removes its state.
+    """
+    return os.path.join(data_path(sample), '_state')
+
+
+def read_state(path):
+    """Return pending raw rows, user-months and birth years of state.
+
+    Parts not yet in state are None.
+    """
+    def read(name):
+        fp = os.path.join(path, f'{name}.parquet')
+        return pd.read_parquet(fp) if os.path.exists(fp) else None
+    profiles = read('profiles')
+    if profiles is not None:
+        profiles = profiles.year_of_birth
+    return read('pending'), read('months'), profiles
+
+
+def write_state(path, pending, months, profiles):
+    os.makedirs(path, exist_ok=True)
+    parts = {'pending': pending, 'months': months,
+             'profiles': None if profiles is None else profiles.to_frame()}
+    for name, part in parts.items():
+        if part is not None:
+            part.to_parquet(os.path.join(path, f'{name}.parquet'))
+
+
+def month_name(month):
+    """Return month index as year-month string."""
+    return f'{month // 12}-{month % 12 + 1:02}'
+
+
+def select_users(months, profiles, users):
+    """Return users meeting selection criteria, given their user-months."""
+    months = months[months.index.get_level_values('user_id').isin(users)]
+    stats = stats_from_months(months)
+    df = pd.DataFrame({'user_id': users,
+                       'year_of_birth': profiles.reindex(users).to_numpy()})
+    with paused():
+        return select_sample(df, stats=stats).user_id
+
+
+def update_data(sample, drop, engine='pandas'):
+    """Add new drop of raw data to clean dataset and sample.
+
+    The latest month of raw data might be incomplete, so it is held back
+    as pending until a later drop contains a newer month, instead of being
+    dropped on each run. Completed months are cleaned and written as a
+    delta file in each user bucket of the dataset, which holds the rows of
+    all users.
+    Selection criteria are re-evaluated from stored user-month aggregates
+    for users with new data only, and the users file, which defines the
+    sample, is updated accordingly.
+
+    Without state, the drop is the full history and the dataset is
+    written from scratch. Raises ValueError if a dataset without state,
+    such as one made by make_data, exists already, rather than replacing
+    it with the drop. Payment pairs spanning the boundary to the
+    pending month are not tagged as transfers, as rows of the pending
+    month are not cleaned yet. Selection counts are not produced, as
+    they refer to the full sample selection of make_data.
+    """
+    state = state_path(sample)
+    pending, months, profiles = read_state(state)
+    clean_path = data_path(sample)
+    is_new = months is None
+    if is_new and os.path.isdir(clean_path) and bucket_dirs(clean_path):
+        raise ValueError(f'Dataset at {clean_path} has no incremental state. '
+                         'Remove it to start updates from a drop of the '
+                         'full history.')
+
+    raw = concat_frames([pending, read_raw(drop, engine=engine)])
+    raw_months = month_index(raw.transaction_date)
+    if months is not None:
+        last = months.index.get_level_values('month').max()
+        if (raw_months <= last).any():
+            raise ValueError('Drop has data of processed months up to '
+                             f'{month_name(last)}.')
+    is_pending = raw_months.eq(raw_months.max())
+    pending = raw[is_pending]
+    if is_pending.all():
+        print('No complete month in drop.')
+        write_state(state, pending, months, profiles)
+        return
+
+    clean = clean_data(raw)
+    name = f'delta-{month_name(raw_months[~is_pending].max())}.parquet'
+    write_buckets(clean, clean_path, name)
+
+    new_months = user_months(clean)
+    months = (new_months if months is None
+              else pd.concat([months, new_months]).sort_index())
+    new_profiles = clean.groupby('user_id').year_of_birth.last()
+    profiles = (new_profiles if profiles is None
+                else new_profiles.combine_first(profiles))
+
+    changed = new_months.index.unique('user_id')
+    selected = select_users(months, profiles, changed)
+    users = (pd.Series([], name='user_id', dtype='int64') if is_new
+             else sample_users(sample))
+    kept = users[~users.isin(changed)]
+    users = pd.Series(sorted(pd.concat([kept, selected])), name='user_id')
+    users.to_csv(users_path(sample), index=False)
+    write_state(state, pending, months, profiles)
+    print(f'{name}: {len(changed)} users updated, {len(users)} in sample.')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    if args.profile or args.trace:
+        profile.enable(args.trace)
+    update_data(args.sample, args.drop, args.engine)
+    if profile.enabled:
+        print(profile.export(f'update_{args.sample}', config.TABDIR))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+import json
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src import config
+from .split_file import user_partitions
+
+
+# Target number of rows per row group
+ROW_GROUP_ROWS = 250_000
+
+# Metadata file at dataset root
+META_NAME = '_dataset.json'
+
+
+def bucket_dir(path, bucket):
+    """Return directory of user bucket in dataset at path."""
+    return os.path.join(path, f'bucket-{bucket:02}')
+
+
+def read_parts(path):
+    """Return number of user buckets recorded in dataset, None if missing."""
+    fp = os.path.join(path, META_NAME)
+    if not os.path.exists(fp):
+        return None
+    with open(fp) as f:
+        return json.load(f)['num_parts']
+
+
+def record_parts(path, num_parts):
+    """Record number of user buckets in dataset at path.
+
+    Raises ValueError if the dataset was written with a different number
+    of buckets, as its users would then be spread over both layouts.
+    """
+    recorded = read_parts(path)
+    if recorded is not None and recorded != num_parts:
+        raise ValueError(f'Dataset at {path} has {recorded} buckets, '
+                         f'not {num_parts}.')
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, META_NAME), 'w') as f:
+        json.dump({'num_parts': num_parts}, f)
+
+
+def user_row_groups(users, rows=ROW_GROUP_ROWS):
+    """Return start and end of row groups of about rows rows.
+
+    users is sorted, and row groups only end where a new user starts, so
+    each user's rows are in a single row group.
+    """
+    if len(users) == 0:
+        return []
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    targets = np.arange(rows, len(users), rows)
+    pos = np.searchsorted(starts, targets)
+    ends = np.unique(starts[pos[pos < len(starts)]])
+    bounds = np.r_[0, ends, len(users)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def write_frame(df, fp, rows=ROW_GROUP_ROWS):
+    """Write df to parquet file in row groups of whole users.
+
+    Rows are sorted by user first unless they already are. Row groups
+    record their minimum and maximum user id, so readers filtering on
+    users skip row groups without them.
+    """
+    if not df.user_id.is_monotonic_increasing:
+        df = df.sort_values('user_id', kind='stable', ignore_index=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with pq.ParquetWriter(fp, table.schema) as writer:
+        for start, end in user_row_groups(df.user_id.to_numpy(), rows):
+            writer.write_table(table.slice(start, end - start))
+
+
+def write_buckets(df, path, name, num_parts=None):
+    """Write rows of df to file name in the bucket of each user.
+
+    Buckets are the partitions into which split_file splits raw data, so
+    that all rows of a user, including those added by incremental
+    updates, are in the same bucket. The number of buckets, by default
+    config.NUM_PARTS, is recorded in the dataset and must match that of
+    earlier writes.
+    """
+    if num_parts is None:
+        num_parts = config.NUM_PARTS
+    record_parts(path, num_parts)
+    buckets = user_partitions(df.user_id.to_numpy(), num_parts)
+    for bucket in np.unique(buckets):
+        write_frame(df[buckets == bucket],
+                    os.path.join(bucket_dir(path, bucket), name))
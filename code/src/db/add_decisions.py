@@ -1,10 +1,20 @@
 import argparse
-import os
-import sqlite3
+import functools
 import sys
 import pandas as pd
 from .decisions import *
 from src import config
+from src.data.read_data import (
+    CHUNK_USERS,
+    chunk_readers,
+    data_path,
+    read_data,
+    users_path,
+)
+from src.helpers.cache import StageCache, fingerprint, hash_values
+from src.helpers.profiling import profile
+from .scheduler import run_chunked, run_declared
+from .database import connection, db_path, sql_values, table_cols
 from .registries import decisions_registry
 
 
@@ -12,52 +22,88 @@ def parse_args(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('sample')
     parser.add_argument('replace')
+    parser.add_argument('--cache', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-users', type=int, default=CHUNK_USERS,
+                        help='users per chunk, 0 for no chunks')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--trace', action='store_true')
     return parser.parse_args()
 
 
-def table_cols(table, conn):
-    """List table columns."""
-    res = pd.read_sql(f"select name from pragma_table_info('{table}');", conn)
-    return res.name.values
+def add_columns(columns, table, conn):
+    """Add columns to table in the transaction of the connection context.
 
-
-def add_column(column, column_name, table, conn):
-    """Add column to table."""
-    column.to_sql('tmp', conn, index=False)
-    conn.executescript(
+    Columns are indexed by user_id. Values are loaded into a temporary
+    staging table keyed on user_id, from which all columns are set in a
+    single update that looks up each user by key. Users not in columns
+    get missing values.
+    """
+    staging = columns.rename_axis('user_id').reset_index()
+    names = list(columns.columns)
+    cols = ', '.join(names)
+    params = ', '.join('?' * len(staging.columns))
+    conn.execute('drop table if exists temp.staging')
+    conn.execute('create temp table staging '
+                 f'(user_id integer primary key, {cols})')
+    conn.executemany(f'insert into staging values ({params})',
+                     sql_values(staging))
+    for name in names:
+        conn.execute(f'alter table {table} add column {name}')
+    conn.execute(
         f"""
-        alter table {table} add column {column_name};
-
         update {table}
-        set {column_name} = (
-            select {column_name} from tmp
-            where {table}.user_id = tmp.user_id);
-
-        drop table tmp;
+        set ({cols}) = (
+            select {cols} from staging
+            where staging.user_id = {table}.user_id)
         """)
+    conn.execute('drop table temp.staging')
+
+
+def decision_column(result, name):
+    """Return decision result as series indexed by user_id."""
+    return result.drop_duplicates('user_id').set_index('user_id')[name]
+
 
+def add_decisions(sample, cache=False, workers=1, chunk_users=CHUNK_USERS):
+    """Calculate pending decision variables and add to database.
 
-def add_decisions(sample):
-    """Calculate decision variables and add to database."""
-    db_name = f'{sample}.db'
-    db_path = os.path.join(config.DATADIR, db_name)
-    conn = sqlite3.connect(db_path)
-    data_name = f'data_{sample}.parquet'
-    data_path = os.path.join(config.TEMPDIR, data_name)
-    data = pd.read_parquet(data_path)
-    tbl_cols = table_cols('decisions', conn)
-    for decision in decisions_registry:
-        if decision.__name__ not in tbl_cols:
-            col = decision(data)
-            col_name = decision.__name__
-            add_column(col, col_name, 'decisions', conn)
+    All decisions not yet in the decisions table are calculated by workers
+    processes first and then written at once. Decisions only read the
+    columns and rows they declare. With chunk_users, they are run on
+    chunks of that many users at a time. With cache, decisions are taken
+    from the stage cache unless the data or the code of the decision has
+    changed, and data is only read if needed.
+    """
+    if chunk_users:
+        data = functools.partial(chunk_readers, sample, size=chunk_users)
+        run = run_chunked
+    else:
+        data = functools.partial(read_data, sample)
+        run = run_declared
+    stage_cache = StageCache() if cache else None
+    data_key = (hash_values(fingerprint(data_path(sample)),
+                            fingerprint(users_path(sample)))
+                if cache else None)
+    with connection(db_path(sample)) as conn:
+        tbl_cols = table_cols('decisions', conn)
+    pending = [d for d in decisions_registry if d.__name__ not in tbl_cols]
+    results = run(pending, data, workers, stage_cache, data_key)
+    columns = [decision_column(result, name) for name, result in results]
+    if columns:
+        with connection(db_path(sample)) as conn:
+            add_columns(pd.concat(columns, axis=1), 'decisions', conn)
 
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv[:1]
     args = parse_args(argv)
-    add_decisions(args.sample)
+    if args.profile or args.trace:
+        profile.enable(args.trace)
+    add_decisions(args.sample, args.cache, args.workers, args.chunk_users)
+    if profile.enabled:
+        print(profile.export(f'decisions_{args.sample}', config.TABDIR))
 
 
 if __name__ == '__main__':
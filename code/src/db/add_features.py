@@ -1,12 +1,20 @@
 import argparse
-import os
-import sqlite3
+import functools
 import sys
 
-import pandas as pd
-
 from .features import *
 from src import config
+from src.data.read_data import (
+    CHUNK_USERS,
+    chunk_readers,
+    data_path,
+    read_pieces,
+    users_path,
+)
+from src.helpers.cache import StageCache, fingerprint, hash_values
+from src.helpers.profiling import profile
+from .scheduler import run_chunked, run_declared
+from .feature_store import FeatureStore
 from .registries import features_registry
 
 
@@ -14,36 +22,57 @@ def parse_args(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('sample')
     parser.add_argument('replace')
+    parser.add_argument('--cache', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-users', type=int, default=CHUNK_USERS,
+                        help='users per chunk, 0 for no chunks')
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--trace', action='store_true')
     return parser.parse_args()
 
 
-def db_tables(connection):
-    """List tables in database."""
-    res = pd.read_sql("select name from sqlite_master", connection)
-    return res.name.values
+def read_stats(sample, columns=None, filters=None):
+    """Return feature statistics of sample, read one bucket at a time."""
+    return FeatureStats.from_pieces(read_pieces(sample, columns, filters))
+
 
+def add_features(sample, cache=False, workers=1, chunk_users=CHUNK_USERS):
+    """Calculate features and add to feature store.
 
-def add_features(sample):
-    """Calculate features and add to database."""
-    db_name = f'{sample}.db'
-    db_path = os.path.join(config.DATADIR, db_name)
-    conn = sqlite3.connect(db_path)
-    data_name = f'data_{sample}.parquet'
-    data_path = os.path.join(config.TEMPDIR, data_name)
-    data = pd.read_parquet(data_path)
-    db_tbls = db_tables(conn)
-    for feature in features_registry:
-        if feature.__name__ not in db_tbls:
-            tbl = feature(data)
-            tbl_name = 'ftr_' + feature.__name__
-            tbl.to_sql(tbl_name, conn)
+    Features are computed by workers processes and stored as they finish.
+    With chunk_users, they are run on chunks of that many users at a
+    time. Otherwise, they are calculated from feature statistics, which
+    are collected one user bucket at a time. With cache, features are
+    taken from the stage cache unless the data or the code of the feature
+    has changed, and data is only read if needed.
+    """
+    store = FeatureStore(sample)
+    if chunk_users:
+        data = functools.partial(chunk_readers, sample, size=chunk_users)
+        run = run_chunked
+    else:
+        data = functools.partial(read_stats, sample)
+        run = run_declared
+    stage_cache = StageCache() if cache else None
+    data_key = (hash_values(fingerprint(data_path(sample)),
+                            fingerprint(users_path(sample)))
+                if cache else None)
+    stored = store.groups()
+    pending = [f for f in features_registry if f.__name__ not in stored]
+    results = run(pending, data, workers, stage_cache, data_key)
+    for name, tbl in results:
+        store.write(name, tbl)
 
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv[:1]
     args = parse_args(argv)
-    add_features(args.sample)
+    if args.profile or args.trace:
+        profile.enable(args.trace)
+    add_features(args.sample, args.cache, args.workers, args.chunk_users)
+    if profile.enabled:
+        print(profile.export(f'features_{args.sample}', config.TABDIR))
 
 
 if __name__ == '__main__':
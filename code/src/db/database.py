@@ -0,0 +1,128 @@
+import atexit
+import contextlib
+import os
+import sqlite3
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_float_dtype, is_integer_dtype
+from src import config
+
+
+PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -256_000,
+    'mmap_size': 2**30,
+    'temp_store': 'memory',
+}
+
+# Rows inserted per transaction
+CHUNK_ROWS = 50_000
+
+# Open connections by process and database path
+_pool = {}
+
+
+def db_path(sample):
+    """Return path of database of sample."""
+    return os.path.join(config.DATADIR, f'{sample}.db')
+
+
+def connect(path):
+    """Return database connection with tuned pragmas."""
+    conn = sqlite3.connect(path)
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f'pragma {pragma} = {value}')
+    return conn
+
+
+@contextlib.contextmanager
+def connection(path):
+    """Yield pooled connection to database at path in a transaction.
+
+    A connection is opened once per process and database and reused by
+    later contexts, so its page cache persists between them. The context
+    begins a transaction that includes schema changes, commits it when
+    the context exits, and rolls it back on error. Contexts entered while
+    a transaction is open join it.
+    """
+    key = os.getpid(), os.path.abspath(path)
+    conn = _pool.get(key)
+    if conn is None:
+        conn = _pool[key] = connect(path)
+    began = not conn.in_transaction
+    if began:
+        conn.execute('begin')
+    try:
+        yield conn
+    except Exception:
+        if began:
+            conn.rollback()
+        raise
+    if began:
+        conn.commit()
+
+
+@atexit.register
+def close_all():
+    """Close connections opened by this process."""
+    for key in [k for k in _pool if k[0] == os.getpid()]:
+        _pool.pop(key).close()
+
+
+def db_tables(conn):
+    """List tables in database."""
+    res = pd.read_sql("select name from sqlite_master", conn)
+    return res.name.values
+
+
+def table_cols(table, conn):
+    """List table columns."""
+    res = pd.read_sql(f"select name from pragma_table_info('{table}');", conn)
+    return res.name.values
+
+
+def sql_type(dtype):
+    """Return SQLite column type of pandas dtype."""
+    if is_integer_dtype(dtype) or is_bool_dtype(dtype):
+        return 'integer'
+    if is_float_dtype(dtype):
+        return 'real'
+    return 'text'
+
+
+def sql_values(df):
+    """Return rows of dataframe as tuples of Python values, NaN as None.
+
+    Columns are converted one at a time. SQLite stores float NaN as NULL,
+    so only non-float columns with missing values go through object dtype.
+    """
+    columns = []
+    for _, col in df.items():
+        if col.hasnans and not is_float_dtype(col.dtype):
+            col = col.astype(object).where(col.notna(), None)
+        columns.append(col.tolist())
+    return list(zip(*columns))
+
+
+def insert_frame(df, table, conn, chunk_rows=CHUNK_ROWS, bulk=False):
+    """Insert rows of dataframe into table, creating it if needed.
+
+    Rows are inserted with executemany in chunks of chunk_rows rows,
+    rather than row by row, so only one chunk of rows is converted to
+    Python values at a time. Table and rows are part of the transaction
+    of the connection context. With bulk, each chunk is committed once
+    inserted instead, which keeps the write-ahead log of large tables
+    small but leaves the table and earlier chunks in place on error.
+    """
+    cols = ', '.join(df.columns)
+    types = ', '.join(f'{name} {sql_type(dtype)}'
+                      for name, dtype in df.dtypes.items())
+    params = ', '.join('?' * len(df.columns))
+    conn.execute(f'create table if not exists {table} ({types})')
+    sql = f'insert into {table} ({cols}) values ({params})'
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        conn.executemany(sql, sql_values(chunk))
+        if bulk:
+            conn.commit()
+            conn.execute('begin')
@@ -1,10 +1,24 @@
 import re
 import numpy as np
 import pandas as pd
-from collections import Counter
-from .registries import decision
+from pandas.api.indexers import BaseIndexer
+from src.helpers.helpers import map_unique
+from src.helpers.profiling import profiled
+from .registries import decision, intermediate, reads, requires
 
 
+def tags_contain(df, pattern):
+    """Return True for txns with pattern in tag, auto tag, or manual tag."""
+    mask = np.zeros(len(df), dtype=bool)
+    for col in ['tag', 'auto_tag', 'manual_tag']:
+        mask |= map_unique(
+            df[col], lambda s: s.str.contains(pattern, na=False)
+        ).to_numpy(dtype=bool)
+    return pd.Series(mask, index=df.index)
+
+
+@intermediate
+@reads('user_id', 'transaction_id', 'transaction_date')
 def active_months(df):
     """Keep user-month observations with at least 12 txs."""
     mnths = df.transaction_date.dt.to_period('M')
@@ -14,6 +28,8 @@ def active_months(df):
 
 
 @decision
+@requires(active_months)
+@reads('transaction_date', 'transaction_description')
 def amazon_per_wk(df):
     """Return number of amazon purchases per week."""
     def helper(g):
@@ -26,6 +42,8 @@ def amazon_per_wk(df):
 
 
 @decision
+@requires(active_months)
+@reads('transaction_date', 'auto_tag')
 def groceries_per_wk(df):
     """Return number of grocery shops per week."""
     def helper(g):
@@ -38,6 +56,8 @@ def groceries_per_wk(df):
 
 
 @decision
+@requires(active_months)
+@reads('transaction_date', 'auto_tag')
 def meals_per_wk(df):
     """Return number of meals out per week."""
     def h(g):
@@ -54,6 +74,7 @@ def meals_per_wk(df):
 # o2 mobile phone payments
 
 
+@intermediate
 def make_o2_subset(df):
     """Keep observations used for o2 classification."""
     misclass = [
@@ -65,9 +86,8 @@ def make_o2_subset(df):
     ]
     prepay = ['pay & go', 'prepay', 'top up']
     regex = re.compile('|'.join(misclass + prepay))
-    tagsum = df[['tag', 'auto_tag', 'manual_tag']].sum(1)
     o2_trx = (
-        (tagsum.str.contains('mobile'))
+        tags_contain(df, 'mobile')
         & (df.merchant_name.eq('o2'))
         & (~df.transaction_description.str.contains(regex))
     )
@@ -75,82 +95,99 @@ def make_o2_subset(df):
     return df[o2_trx & credits]
 
 
+@profiled
 def large_payment(df, thresh=100):
     """Identify potentil phone purchases."""
     df['large_payment'] = df.amount > thresh
     return df
 
 
+class WindowBounds(BaseIndexer):
+    """Rolling window indexer with precomputed start and end bounds."""
+
+    def get_window_bounds(self, num_values=0, min_periods=None, center=None,
+                          closed=None, step=None):
+        return self.start, self.end
+
+
+def group_rolling_mean(s, groups, window, center=False):
+    """Return rolling mean of s within groups of consecutive rows.
+
+    Window bounds are those pandas uses when rolling each group on its
+    own, so results equal groupby rolling, but bounds are computed for all
+    groups at once.
+    """
+    pos = np.arange(len(s))
+    new = np.r_[True, groups.to_numpy()[1:] != groups.to_numpy()[:-1]]
+    starts = np.flatnonzero(new)
+    sizes = np.diff(np.r_[starts, len(s)])
+    group_start = np.repeat(starts, sizes)
+    group_end = group_start + np.repeat(sizes, sizes)
+    end = pos + 1 + ((window - 1) // 2 if center else 0)
+    start = np.clip(end - window, group_start, group_end)
+    end = np.clip(end, group_start, group_end)
+    bounds = WindowBounds(start=start.astype('int64'),
+                          end=end.astype('int64'))
+    return s.rolling(bounds, min_periods=window).mean()
+
+
+@profiled
 def larger_than_neighbours(df, multiple=3, window=20):
     """Identify payments that are larger than their neighbours.
 
     Ensures temporary high airtime bills aren't mistaken for phone purchase.
     """
-    def helper(g):
-        center = g.amount.rolling(window, center=True).mean()
-        right = g.amount.rolling(window).mean()
-        left = g.amount.rolling(half_window).mean().shift(-(half_window-1))
-        mean = g.amount.mean()
-        rolling = center
-        rolling = rolling.where(rolling.notna(), right)  # fill start
-        rolling = rolling.where(rolling.notna(), left)   # fill end
-        rolling = rolling.where(rolling.notna(), mean)   # if obs < window
-        g['larger_than_neighbours'] = g.amount > rolling * multiple
-        return g
-
     half_window = round(window/2)
     df = df.sort_values(['user_id', 'transaction_date'])
-    return df.groupby('user_id').apply(helper)
+    users = df.user_id
+    center = group_rolling_mean(df.amount, users, window, center=True)
+    right = group_rolling_mean(df.amount, users, window)
+    left = (group_rolling_mean(df.amount, users, half_window)
+            .groupby(users).shift(-(half_window-1)))
+    mean = df.amount.groupby(users).transform('mean')
+    rolling = center
+    rolling = rolling.where(rolling.notna(), right)  # fill start
+    rolling = rolling.where(rolling.notna(), left)   # fill end
+    rolling = rolling.where(rolling.notna(), mean)   # if obs < window
+    df['larger_than_neighbours'] = df.amount > rolling * multiple
+    return df
 
 
+@profiled
 def rare_large_payment(df, thresh=100):
     """Return true if user makes no more than one large payment per year.
 
     Ensures regular high airtime bills aren't classified as phone purchases.
     """
-    def helper(g):
-        num_years = g.transaction_date.dt.year.nunique()
-        num_large_paym = (g.amount > thresh).sum()
-        g['rare_large_payment'] = num_large_paym <= num_years
-        return g
-
-    return df.groupby('user_id').apply(helper)
+    users = df.user_id
+    num_years = (df.transaction_date.dt.year
+                 .groupby(users).transform('nunique'))
+    num_large_paym = (df.amount > thresh).groupby(users).transform('sum')
+    df['rare_large_payment'] = num_large_paym <= num_years
+    return df
 
 
+@profiled
 def multiple_payments(df):
     """Return true if user made multiple o2 pmts on same day.
 
     Indicator for airtime and phone payments.
     """
-    def helper(g):
-        g['multiple_payments'] = len(g.index) > 1
-        return g
-
-    return df.groupby(['user_id', 'transaction_date']).apply(helper)
+    g = df.groupby(['user_id', 'transaction_date'])
+    df['multiple_payments'] = g.user_id.transform('size') > 1
+    return df
 
 
+@profiled
 def long_series(df, min_length=6):
     """Tag users with large number of duplicate amounts."""
-    data = list(zip(df.user_id, df.amount))
-
-    # dict with user_id as key and amounts as list of values
-    idx = {}
-    for d in data:
-        idx.setdefault(d[0], []).append(d[1])
-
-    # dict with user_id as key and count of most occuring amount as value
-    result = {}
-    for user_id in idx:
-        counts = Counter(idx[user_id]).values()
-        result[user_id] = max(counts)
-
-    # test condition and append to df
-    s = pd.Series(result) > min_length
+    counts = df.groupby(['user_id', 'amount']).size()
+    s = counts.groupby('user_id').max() > min_length
     s.name = 'long_series'
-    s.index.name = 'user_id'
     return df.merge(s.reset_index(), validate='m:1')
 
 
+@profiled
 def classify_o2(df):
     """Classify users as upfront or instalment payers.
 
@@ -160,28 +197,22 @@ def classify_o2(df):
                & df.rare_large_payment
                & df.larger_than_neighbours)
     instalments = df.long_series & df.multiple_payments
-    df['o2_phone'] = 0
-    df['o2_phone'] = np.where(upfront & ~instalments, 1, df.o2_phone)
-    df['o2_phone'] = np.where(instalments & ~upfront, 2, df.o2_phone)
-
-    def helper(g):
-        sum = g.o2_phone.sum()
-        if (sum == 0) | (sum == 3):
-            g['o2_phone'] = None
-            return g
-        elif sum == 1:
-            g['o2_phone'] = 1
-            return g
-        elif sum == 2:
-            g['o2_phone'] = 0
-            return g
-
-    df = df[['user_id', 'o2_phone']].drop_duplicates()
-    df = df.groupby('user_id').apply(helper)
-    return df.drop_duplicates()
+    g = pd.DataFrame({
+        'upfront': upfront & ~instalments,
+        'instalments': instalments & ~upfront,
+    }).groupby(df.user_id)
+    any_upfront, any_instalments = g.upfront.any(), g.instalments.any()
+    o2_phone = pd.Series(None, index=any_upfront.index, dtype=object)
+    o2_phone[any_upfront & ~any_instalments] = 1
+    o2_phone[any_instalments & ~any_upfront] = 0
+    return o2_phone.rename('o2_phone').reset_index()
 
 
 @decision
+@requires(make_o2_subset)
+@reads('user_id', 'transaction_date', 'amount', 'transaction_description',
+       'merchant_name', 'tag', 'auto_tag', 'manual_tag',
+       filters=[('merchant_name', '==', 'o2'), ('amount', '>', 0)])
 def o2_phone(df):
     """Create dummy indicating mode of payment for new phone."""
     return (
@@ -200,15 +231,16 @@ def o2_phone(df):
 # car insurance payments
 
 
+@intermediate
 def make_carins_subset(df):
     """Keep observations used for car insurance classification."""
-    tagsum = df[['tag', 'auto_tag', 'manual_tag']].sum(1)
-    carins_trans = ((tagsum.str.contains('vehicle insurance'))
+    carins_trans = (tags_contain(df, 'vehicle insurance')
                     & (df.manual_tag.ne('home insurance')))
     credit = df.amount > 0
     return df[carins_trans & credit]
 
 
+@profiled
 def payment_series(df, thresh=5):
     """Return true if user has series of payments of same amount.
 
@@ -222,19 +254,19 @@ def payment_series(df, thresh=5):
     cars (two parallel payment streaks on alternating dates),
     as well as to random/misclassified payments.
     """
-    def helper(g):
-        diff = g.amount.diff()
-        longest = diff.cumsum().value_counts().max()
-        g['series'] = longest >= thresh
-        return g
-
     if df.empty:
         df['series'] = None
         return df
     df = df.sort_values(['user_id', 'amount'])
-    return df.groupby('user_id').apply(helper)
+    users = df.user_id
+    steps = df.amount.groupby(users).diff().groupby(users).cumsum()
+    longest = (steps.groupby([users, steps]).size()
+               .groupby('user_id').max())
+    df['series'] = users.map(longest) >= thresh
+    return df
 
 
+@profiled
 def large_payments(df, thresh=250):
     """Return true if user made unique large payment.
 
@@ -243,16 +275,15 @@ def large_payments(df, thresh=250):
     take into account that some users might make montlhy
     payments that are higher than the hlp_threshold.
     """
-    def helper(g):
-        g['large_paym'] = (g.amount > thresh).max()
-        return g
-
     if df.empty:
         df['large_paym'] = None
         return df
-    return df.groupby('user_id').apply(helper)
+    large = df.amount > thresh
+    df['large_paym'] = large.groupby(df.user_id).transform('max')
+    return df
 
 
+@profiled
 def classify_carins(df):
     """Classify users as monthly or yearly.
 
@@ -267,6 +298,9 @@ def classify_carins(df):
 
 
 @decision
+@requires(make_carins_subset)
+@reads('user_id', 'amount', 'tag', 'auto_tag', 'manual_tag',
+       filters=[('amount', '>', 0)])
 def carins_paym(df):
     """Create dummy indicating mode of payment for car insurance."""
     return (
@@ -283,6 +317,7 @@ def carins_paym(df):
 
 
 @decision
+@reads('user_id', 'transaction_date', 'auto_tag', 'merchant_name')
 def insurer_swaps(df, thresh=1/3):
     """Classify user as frequent or infrequent insurer swapper.
 
@@ -290,21 +325,22 @@ def insurer_swaps(df, thresh=1/3):
     per year; if thresh equals 0.5, a frequent swaper makes at least one swap
     every other year.
     """
-    def helper(g):
-        num_trans = g.auto_tag.str.match('(vehicle|home) insurance').sum()
-        if num_trans == 0:
-            return None
-
-        years = g.transaction_date.dt.year.nunique()
-
-        mask = g.auto_tag.str.match('home insurance')
-        swaps = max(0, g[mask].merchant_name.nunique() - 1)
-        mask = g.auto_tag.str.match('vehicle insurance')
-        swaps += max(0, g[mask].merchant_name.nunique() - 1)
-
-        return 1 if (swaps / years) > thresh else 0
-
-    return (df.groupby('user_id')
-            .apply(helper)
+    is_home = map_unique(df.auto_tag,
+                         lambda s: s.str.match('home insurance').eq(True))
+    is_vehicle = map_unique(
+        df.auto_tag, lambda s: s.str.match('vehicle insurance').eq(True))
+    users = df.user_id
+    years = df.transaction_date.dt.year.groupby(users).nunique()
+    has_insurance = (is_home | is_vehicle).groupby(users).any()
+
+    def swaps(mask):
+        merchants = df.merchant_name[mask].groupby(users[mask]).nunique()
+        return (merchants.reindex(years.index, fill_value=0) - 1).clip(0)
+
+    swappers = np.where(
+        (swaps(is_home) + swaps(is_vehicle)) / years > thresh, 1, 0)
+    # build from Python values so dtype is inferred as for a groupby apply
+    labels = np.where(has_insurance, swappers, None).tolist()
+    return (pd.Series(labels, index=years.index)
             .rename('insurer_swaps')
             .reset_index())
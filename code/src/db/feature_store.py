@@ -0,0 +1,164 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src import config
+from src.helpers.helpers import from_long, is_sparse, to_long
+
+
+def long_format(table):
+    """Return feature table as long dataframe of user_id, feature, value.
+
+    Sparse tables keep only nonzero entries, dense tables keep all entries
+    including missing values.
+    """
+    if is_sparse(table):
+        long = to_long(table)
+    else:
+        long = (table.to_frame() if isinstance(table, pd.Series) else table)
+        long = (long.rename_axis('user_id')
+                .reset_index()
+                .melt('user_id', var_name='feature'))
+    long['feature'] = long.feature.astype(str)
+    long['value'] = long.value.astype('float64')
+    return long.sort_values(['feature', 'user_id'], ignore_index=True)
+
+
+def feature_names(table):
+    """Return names of features in feature table."""
+    if isinstance(table, pd.Series):
+        return [str(table.name)]
+    return [str(c) for c in table.columns]
+
+
+class FeatureStore:
+    """Long-format parquet store of features.
+
+    Each feature group, the table returned by one feature function, is
+    stored in its own file of user_id, feature, value rows sorted by
+    feature and user_id. Row group statistics on both columns let reads
+    of a subset of features or users skip the remaining row groups, so
+    the number of stored features does not limit what can be loaded.
+    """
+
+    def __init__(self, sample, root=None, row_group_size=2**16):
+        if root is None:
+            root = os.path.join(config.DATADIR, f'features_{sample}')
+        self.root = root
+        self.row_group_size = row_group_size
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, group):
+        return os.path.join(self.root, group + '.parquet')
+
+    @property
+    def manifest(self):
+        """Return dict of stored groups with their features."""
+        fp = os.path.join(self.root, 'manifest.json')
+        if not os.path.exists(fp):
+            return {}
+        with open(fp) as f:
+            return json.load(f)
+
+    def groups(self):
+        return list(self.manifest)
+
+    def write(self, group, table):
+        """Store feature table as group, replacing existing group."""
+        self._write(group, long_format(table), feature_names(table),
+                    is_sparse(table))
+
+    def update(self, group, table, users):
+        """Replace features of users in group by those in table.
+
+        users are all users whose features changed, so those of them not in
+        table are removed from the group. Features new to the group are
+        added after existing ones.
+        """
+        manifest = self.manifest
+        if group not in manifest:
+            return self.write(group, table)
+        long = self.read(group)
+        long = pd.concat([long[~long.user_id.isin(users)],
+                          long_format(table)], ignore_index=True)
+        long = long.sort_values(['feature', 'user_id'], ignore_index=True)
+        features = manifest[group]['features']
+        known = set(features)
+        features = features + [f for f in feature_names(table)
+                               if f not in known]
+        self._write(group, long, features, manifest[group]['sparse'])
+
+    def _write(self, group, long, features, sparse):
+        schema = pa.schema([
+            ('user_id', pa.from_numpy_dtype(long.user_id.dtype)),
+            ('feature', pa.dictionary(pa.int32(), pa.string())),
+            ('value', pa.float64()),
+        ])
+        data = pa.Table.from_pandas(long, schema=schema, preserve_index=False)
+        tmp = self.path(group) + '.tmp'
+        pq.write_table(data, tmp, row_group_size=self.row_group_size)
+        os.replace(tmp, self.path(group))
+        manifest = self.manifest
+        manifest[group] = {'features': features, 'sparse': sparse}
+        with open(os.path.join(self.root, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+    def read(self, group, features=None, users=None):
+        """Return long dataframe of group for features and users."""
+        filters = []
+        if features is not None:
+            filters.append(('feature', 'in', list(features)))
+        if users is not None:
+            filters.append(('user_id', 'in', list(users)))
+        data = pq.read_table(self.path(group), filters=filters or None)
+        long = data.to_pandas()
+        long['feature'] = long.feature.astype(str)
+        return long
+
+    def table(self, groups=None, features=None, users=None, sparse=False):
+        """Return user by feature table for groups, features and users.
+
+        Groups default to all stored groups, and features to all features
+        of those groups. Only groups holding requested features are read.
+        Rows are the requested users, or all users in the dense groups
+        read. Missing entries are zero for sparse groups and missing
+        otherwise. With sparse, all columns are sparse.
+        """
+        manifest = self.manifest
+        if groups is None:
+            groups = list(manifest)
+        if features is not None:
+            features = set(features)
+            groups = [g for g in groups
+                      if features.intersection(manifest[g]['features'])]
+        longs = {g: self.read(g, features, users) for g in groups}
+        if users is None:
+            dense = [long for g, long in longs.items()
+                     if not manifest[g]['sparse']] or list(longs.values())
+            users = (np.unique(np.concatenate(
+                [long.user_id.to_numpy() for long in dense])) if dense else [])
+        rows = pd.Index(users, name='user_id')
+
+        tables = []
+        for g, long in longs.items():
+            columns = pd.Index([f for f in manifest[g]['features']
+                                if features is None or f in features])
+            if manifest[g]['sparse']:
+                t = from_long(long, rows=rows, columns=columns)
+                if not sparse:
+                    t = t.sparse.to_dense()
+            else:
+                t = (long.pivot(index='user_id', columns='feature',
+                                values='value')
+                     .reindex(index=rows, columns=columns))
+                t.columns.name = None
+                if sparse:
+                    t = t.astype(pd.SparseDtype('float64', 0))
+            tables.append(t)
+        if not tables:
+            return pd.DataFrame(index=rows)
+        return pd.concat(tables, axis=1)
@@ -1,140 +1,286 @@
+import os
+
+import numpy as np
 import pandas as pd
-from .registries import feature, preproc
+from scipy import sparse, special
+
+from src.helpers.helpers import map_unique
+from .registries import feature, intermediate, preproc, reads, requires
+
+
+@intermediate
+def debits(df):
+    """Return debit transactions."""
+    return df[df.credit_debit.eq('debit')]
+
+
+def clean_label(s, length=None):
+    """Return labels without non-word characters, cut to length."""
+    return s.str.replace(r'\W', '', regex=True).str[:length]
+
+
+def _object_labels(s):
+    """Return series with second index level as object labels."""
+    labels = s.index.levels[1].astype(object)
+    return s.set_axis(s.index.set_levels(labels, level=1))
+
+
+class FeatureStats:
+    """Per-user sufficient statistics of features.
+
+    Statistics are counts, sums, minima and maxima over transactions, so
+    statistics of new transactions merge into those of earlier ones and
+    features of a user can be updated without rereading their history.
+
+    sums holds per-user totals, tag_counts debit counts by user and auto
+    tag, and spend debit spending by user and cleaned label for each
+    (column, length) in CATEGORIES. Statistics are calculated from
+    COLUMNS of the data.
+    """
+
+    CATEGORIES = [('merchant_name', 10), ('auto_tag', 10), ('auto_tag', None)]
+    COLUMNS = ['user_id', 'transaction_id', 'transaction_date', 'amount',
+               'credit_debit', 'account_type', 'merchant_name', 'auto_tag',
+               'manual_tag']
+
+    def __init__(self, sums, tag_counts, spend):
+        self.sums = sums
+        self.tag_counts = tag_counts
+        self.spend = spend
+
+    @classmethod
+    def from_data(cls, df):
+        is_manual = map_unique(df.manual_tag,
+                               lambda s: s.str.match('(?!no tag)').eq(True))
+        is_grocery = map_unique(df.auto_tag,
+                                lambda s: s.eq('food, groceries, household'))
+        data = pd.DataFrame({
+            'user_id': df.user_id.to_numpy(),
+            'amount': df.amount.to_numpy(),
+            'date': df.transaction_date.to_numpy(),
+            'is_manual': is_manual.to_numpy(dtype=bool),
+            'grocery_id': df.transaction_id.where(
+                is_grocery.to_numpy(dtype=bool)).to_numpy(),
+        })
+        g = data.groupby('user_id')
+        sums = pd.DataFrame({
+            'num_txns': g.amount.count(),
+            'num_manual': g.is_manual.sum(),
+            'first_date': g.date.min(),
+            'last_date': g.date.max(),
+            'num_shops': g.grocery_id.nunique(),
+        })
+
+        dr = debits(df)
+        data = pd.DataFrame({
+            'user_id': dr.user_id.to_numpy(),
+            'amount': np.nan_to_num(dr.amount.to_numpy(dtype='float64')),
+            'is_credit': dr.account_type.eq('credit card').to_numpy(),
+            'auto_tag': dr.auto_tag.to_numpy(),
+        })
+        g = data.groupby('user_id')
+        for name, values in [('num_debits', g.size()),
+                             ('num_credit', g.is_credit.sum()),
+                             ('debit_spend', g.amount.sum())]:
+            sums[name] = values.reindex(sums.index, fill_value=0)
+        tag_counts = _object_labels(
+            data.groupby(['user_id', 'auto_tag'], observed=True).size())
+
+        spend = {}
+        for column, length in cls.CATEGORIES:
+            labels = map_unique(dr[column], lambda s: clean_label(s, length))
+            spend[column, length] = (
+                data.amount.groupby([data.user_id, labels.to_numpy()])
+                .sum().rename_axis(['user_id', 'label']))
+        return cls(sums, tag_counts.rename_axis(['user_id', 'auto_tag']),
+                   spend)
+
+    @classmethod
+    def from_pieces(cls, pieces):
+        """Return statistics of data read one piece at a time."""
+        stats = None
+        for df in pieces:
+            if df.empty:
+                continue
+            new = cls.from_data(df)
+            stats = new if stats is None else stats.merge(new)
+        return stats
+
+    def merge(self, other):
+        """Return statistics of transactions of self and other."""
+        sums = pd.concat([self.sums, other.sums]).groupby('user_id')
+        merged = sums.sum(numeric_only=True)
+        merged['first_date'] = sums.first_date.min()
+        merged['last_date'] = sums.last_date.max()
+        tag_counts = (pd.concat([self.tag_counts, other.tag_counts])
+                      .groupby(level=[0, 1]).sum())
+        spend = {key: (pd.concat([self.spend[key], other.spend[key]])
+                       .groupby(level=[0, 1]).sum())
+                 for key in self.spend}
+        return FeatureStats(merged[self.sums.columns], tag_counts, spend)
+
+    def users(self, users):
+        """Return statistics of users."""
+        def subset(s):
+            return s[s.index.get_level_values('user_id').isin(users)]
+        return FeatureStats(subset(self.sums), subset(self.tag_counts),
+                            {k: subset(v) for k, v in self.spend.items()})
+
+    @staticmethod
+    def _spend_name(key):
+        column, length = key
+        return f'spend_{column}_{length or "all"}.parquet'
+
+    def save(self, path):
+        """Write statistics to parquet files in directory path."""
+        os.makedirs(path, exist_ok=True)
+        self.sums.to_parquet(os.path.join(path, 'sums.parquet'))
+        (self.tag_counts.rename('count').to_frame()
+         .to_parquet(os.path.join(path, 'tag_counts.parquet')))
+        for key, spend in self.spend.items():
+            (spend.rename('spend').to_frame()
+             .to_parquet(os.path.join(path, self._spend_name(key))))
+
+    @classmethod
+    def load(cls, path):
+        """Return statistics written to directory path."""
+        def read(name):
+            return pd.read_parquet(os.path.join(path, name))
+        spend = {key: read(cls._spend_name(key)).spend
+                 for key in cls.CATEGORIES}
+        return cls(read('sums.parquet'), read('tag_counts.parquet')['count'],
+                   spend)
+
+
+@intermediate
+@reads(*FeatureStats.COLUMNS)
+def feature_stats(df):
+    """Return sufficient statistics of features.
+
+    Features are calculated from these, so they can also be passed
+    statistics directly, which are returned as they are.
+    """
+    if isinstance(df, FeatureStats):
+        return df
+    return FeatureStats.from_data(df)
+
+
+@intermediate
+@reads(*FeatureStats.COLUMNS)
+def user_aggregates(df):
+    """Return per-user aggregates used by scalar features."""
+    stats = feature_stats(df)
+    sums = stats.sums
+    aggs = sums[['num_txns', 'num_manual']].copy()
+    aggs['num_weeks'] = (sums.last_date - sums.first_date) / pd.Timedelta('1W')
+    aggs['num_shops'] = sums.num_shops
+    has_debits = sums.num_debits > 0
+    aggs['num_debits'] = sums.num_debits.where(has_debits)
+    aggs['num_credit'] = sums.num_credit.where(has_debits)
+
+    # Shannon entropy of add-one smoothed tag frequencies, which equals
+    # the entropy of (n + 1) / (total + num_tags) after normalisation.
+    freqs = stats.tag_counts + 1
+    probs = freqs / freqs.groupby('user_id').transform('sum')
+    entropy = (pd.Series(special.entr(probs.to_numpy()), index=probs.index)
+               .groupby('user_id').sum()
+               .reindex(sums.index, fill_value=0)
+               / np.log(2))
+    aggs['entropy'] = entropy.where(has_debits)
+    return aggs
 
 
 @preproc
 @feature
+@requires(user_aggregates)
 def pct_manual_tags(df):
     """Return proportion of tags manually set by user."""
-    def helper(g):
-        num_trans = g.amount.count()
-        num_manual_tags = g.manual_tag.str.match('(?!no tag)').sum()
-        return num_manual_tags / num_trans
-
-    return df.groupby('user_id').apply(helper).rename('pct_manual_tags')
+    aggs = user_aggregates(df)
+    return (aggs.num_manual / aggs.num_txns).rename('pct_manual_tags')
 
 
 @preproc
 @feature
+@requires(user_aggregates)
 def pct_credit(df):
     """Percentage of purchases financed by credit card."""
-    def helper(g):
-        mask = g.credit_debit.eq('debit')
-        total_trans = g[mask].amount.count()
-        credit_trans = g[mask].account_type.eq('credit card').sum()
-        return credit_trans / total_trans
-
-    return df.groupby('user_id').apply(helper).rename('pct_credit')
+    aggs = user_aggregates(df)
+    return (aggs.num_credit / aggs.num_debits).rename('pct_credit')
 
 
 @preproc
 @feature
+@requires(user_aggregates)
 def entropy(df):
     """Return Shannon Entropy for purchases of each user."""
-    from scipy.stats import entropy
-    mask = df.credit_debit.eq('debit')
-    df = df[mask]
-    num_cats = df.auto_tag.nunique()
-
-    def calc_entropy(user, num_cats):
-        total_purchases = len(user)
-        cat_purchases = user.groupby('auto_tag').size()
-        probs = (cat_purchases + 1) / (total_purchases + num_cats)
-        return entropy(probs, base=2)
-
-    g = df.groupby('user_id')
-    return g.apply(calc_entropy, num_cats).rename('entropy')
+    return user_aggregates(df).entropy.dropna().rename('entropy')
+
+
+def debit_crosstab(df, column, prefix, length=None, shares=False):
+    """Return sparse table of user debit spending by category.
+
+    Categories are cleaned labels of column. Values are spending shares if
+    shares is True, and otherwise indicate positive spending. Table is
+    built from a sparse matrix over users with debits and categories.
+    """
+    stats = feature_stats(df)
+    users = stats.sums.index[stats.sums.num_debits > 0]
+    spend = stats.spend[column, length]
+    rows = users.get_indexer(spend.index.get_level_values('user_id'))
+    cols, cats = pd.factorize(spend.index.get_level_values('label'),
+                              sort=True)
+    values = sparse.csr_matrix(
+        (spend.to_numpy(dtype='float64'), (rows, cols)),
+        shape=(len(users), len(cats)))
+    if shares:
+        total = stats.sums.debit_spend.reindex(users).to_numpy()
+        with np.errstate(divide='ignore'):
+            values = sparse.diags(1 / total) @ values
+    else:
+        values = (values > 0).astype('float64')
+    values.eliminate_zeros()
+    return pd.DataFrame.sparse.from_spmatrix(
+        values,
+        index=pd.Index(users, name='user_id'),
+        columns=prefix + pd.Index(cats, dtype=object))
 
 
 @feature
+@requires(feature_stats)
 def merchant_dummies(df):
     """Indicate whether user made purchase from merchant."""
-    mask = df.credit_debit.eq('debit')
-    df = df[mask].copy()
-    df['merchant_name'] = (df.merchant_name
-                           .str.replace('\W', '')
-                           .str.replace(' ', '_')
-                           .str[:10])
-
-    def helper(g):
-        return ((g.groupby('merchant_name').amount.sum() > 0)
-                .astype(int)
-                .add_prefix('merch_'))
-
-    return df.groupby('user_id').apply(helper).unstack().fillna(0)
+    return debit_crosstab(df, 'merchant_name', 'merch_', length=10)
 
 
 @feature
+@requires(feature_stats)
 def tag_dummies(df):
     """Indicate whether user made purchase classified by tag."""
-    mask = df.credit_debit.eq('debit')
-    df = df[mask].copy()
-
-    df['auto_tag'] = (df.auto_tag
-                      .str.replace('\W', '')
-                      .str.replace(' ', '_')
-                      .str[:10])
-
-    def helper(g):
-        return ((g.groupby('auto_tag').amount.sum() > 0)
-                .astype(int)
-                .add_prefix('tag_'))
-
-    return df.groupby('user_id').apply(helper).unstack().fillna(0)
+    return debit_crosstab(df, 'auto_tag', 'tag_', length=10)
 
 
 @feature
+@requires(feature_stats)
 def merchant_spending_shares(df):
     """Return spending shares by merchant."""
-    mask = df.credit_debit.eq('debit')
-    df = df[mask].copy()
-
-    df['merchant_name'] = (df.merchant_name
-                           .str.replace('\W', '')
-                           .str.replace(' ', '_')
-                           .str[:10])
-
-    def helper(g):
-        merch_spending = g.groupby('merchant_name').amount.sum()
-        total_spending = g.amount.sum()
-        shares = merch_spending / total_spending
-        return shares.add_prefix('merchshare_')
-    return df.groupby('user_id').apply(helper).unstack().fillna(0)
+    return debit_crosstab(df, 'merchant_name', 'merchshare_', length=10,
+                          shares=True)
 
 
 @feature
+@requires(feature_stats)
 def tag_spending_shares(df):
     """Return spending shares by tag."""
-    mask = df.credit_debit.eq('debit')
-    df = df[mask].copy()
-
-    df['auto_tag'] = (df.auto_tag
-                      .str.replace('\W', '')
-                      .str.replace(' ', '_'))
-
-    def helper(g):
-        tag_spending = g.groupby('auto_tag').amount.sum()
-        total_spending = g.amount.sum()
-        shares = tag_spending / total_spending
-        return shares.add_prefix('tagshare_')
-    return df.groupby('user_id').apply(helper).unstack().fillna(0)
+    return debit_crosstab(df, 'auto_tag', 'tagshare_', shares=True)
 
 
 @preproc
 @feature
+@requires(user_aggregates)
 def grocery_shop_freq(df):
     """Return number of grocery shops per week."""
-    def helper(g):
-        num_days = g.transaction_date.max() - g.transaction_date.min()
-        num_weeks = num_days / pd.Timedelta('1W')
-        mask = g.auto_tag.eq('food, groceries, household')
-        num_shops = g[mask].transaction_id.nunique()
-        return num_shops / num_weeks
-    return (
-        df.groupby('user_id')
-        .apply(helper)
-        .rename('grocery_shop_freq')
-    )
+    aggs = user_aggregates(df)
+    return (aggs.num_shops / aggs.num_weeks).rename('grocery_shop_freq')
 
 
 def tag_merchant_dummies(df):
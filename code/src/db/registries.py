@@ -1,7 +1,60 @@
+from functools import wraps
+import weakref
+
+
 decisions_registry = set()
 features_registry = set()
 variable_registry = set()
 preproc_registry = set()
+intermediates_registry = {}
+
+
+def last_frame(func):
+    """Memoise func for the most recently passed dataframe."""
+    memo = {}
+
+    @wraps(func)
+    def wrapper(df):
+        if memo and memo['frame']() is df:
+            return memo['result']
+        result = func(df)
+        memo.update(frame=weakref.ref(df), result=result)
+        return result
+    return wrapper
+
+
+def intermediate(func):
+    """Register intermediate input shared by features and decisions.
+
+    Results are memoised for the most recent dataframe, so consumers share
+    one result and must not modify it.
+    """
+    func = last_frame(func)
+    intermediates_registry[func.__name__] = func
+    return func
+
+
+def requires(*intermediates):
+    """Declare intermediate inputs of feature or decision."""
+    def wrapper(func):
+        func.requires = intermediates
+        return func
+    return wrapper
+
+
+def reads(*columns, filters=None):
+    """Declare columns and row filters of data that feature or decision needs.
+
+    Filters are (column, op, value) tuples as in pd.read_parquet, all of
+    which rows must meet. Data read for func may be limited to these rows
+    and columns, together with the columns declared by its intermediates,
+    so func must return the same result on them as on the full data.
+    """
+    def wrapper(func):
+        func.columns = list(columns)
+        func.filters = list(filters or [])
+        return func
+    return wrapper
 
 
 def decision(func):
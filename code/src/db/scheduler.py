@@ -0,0 +1,242 @@
+import functools
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+from src.helpers.cache import stage_key
+from src.helpers.helpers import from_long, is_sparse, to_long
+from src.helpers.profiling import profile
+
+
+# Data shared with forked workers
+_shared = {}
+
+
+def required_intermediates(funcs):
+    """Return intermediates declared by funcs, in order of first use."""
+    result = []
+    for func in funcs:
+        for inter in getattr(func, 'requires', ()):
+            if inter not in result:
+                result.append(inter)
+    return result
+
+
+def data_needs(func):
+    """Return columns and filters of data that func needs.
+
+    Columns are those declared by func and its intermediates, or None if
+    none of them declares any. Filters are those declared by func.
+    """
+    declared = [f.columns for f in [func, *getattr(func, 'requires', ())]
+                if hasattr(f, 'columns')]
+    if not declared:
+        return None, []
+    columns = sorted(set(['user_id']).union(*declared))
+    return columns, getattr(func, 'filters', [])
+
+
+def cached(cache, key):
+    """Return output stored under key in cache, or None if not stored."""
+    if cache is None:
+        return None
+    try:
+        return cache.load(key)[0]
+    except FileNotFoundError:
+        return None
+
+
+def _compute(i):
+    func = _shared['funcs'][i]
+    start = len(profile.records)
+    result = profile.call(func, _shared['data'])
+    return i, result, profile.records[start:]
+
+
+def run_registered(funcs, data, workers=1, cache=None, data_key=None):
+    """Yield name and result of each function as it finishes.
+
+    data is a callable returning the dataframe, which is only called if a
+    result needs computing. With cache, results are taken from and added
+    to the stage cache. Intermediates declared by the functions are
+    computed once before functions run. With more than one worker,
+    functions run in forked processes that share the dataframe and the
+    intermediates with this process instead of receiving copies. Profiles
+    of functions run in workers are added to the profile of this process.
+    """
+    funcs = list(funcs)
+    keys = [stage_key(func, data_key, {}) if cache else None
+            for func in funcs]
+    todo = []
+    for i, (func, key) in enumerate(zip(funcs, keys)):
+        result = cached(cache, key)
+        if result is None:
+            todo.append(i)
+        else:
+            yield func.__name__, result
+    if not todo:
+        return
+
+    df = data()
+    for inter in required_intermediates(funcs[i] for i in todo):
+        profile.call(inter, df)
+
+    if workers > 1 and len(todo) > 1:
+        _shared.update(funcs=funcs, data=df)
+        ctx = mp.get_context('fork')
+        try:
+            with ctx.Pool(min(workers, len(todo))) as pool:
+                results = pool.imap_unordered(_compute, todo)
+                yield from _finish(results, funcs, keys, cache)
+        finally:
+            _shared.clear()
+    else:
+        results = ((i, profile.call(funcs[i], df), []) for i in todo)
+        yield from _finish(results, funcs, keys, cache)
+
+
+def _finish(results, funcs, keys, cache):
+    for i, result, records in results:
+        profile.records.extend(records)
+        if cache:
+            cache.save(keys[i], result, {})
+        yield funcs[i].__name__, result
+
+
+def declared_groups(funcs):
+    """Return columns, filters, and functions of groups of functions.
+
+    Functions with the same filters form a group, which needs the columns
+    any of them needs, or all columns if one doesn't declare any.
+    """
+    groups = {}
+    for func in funcs:
+        columns, filters = data_needs(func)
+        _, group_columns, group = groups.setdefault(
+            repr(filters), (filters, set(), []))
+        group.append(func)
+        if columns is None:
+            group_columns.add(None)
+        else:
+            group_columns.update(columns)
+    return [(None if None in columns else sorted(columns), filters, group)
+            for filters, columns, group in groups.values()]
+
+
+def run_declared(funcs, data, workers=1, cache=None, data_key=None):
+    """Yield name and result of each function, reading only data it needs.
+
+    data is a callable taking columns and filters. Functions with the same
+    filters share one read of the columns any of them needs, and run as
+    in run_registered. Functions that declare no columns get all columns.
+    """
+    for columns, filters, group in declared_groups(funcs):
+        read = functools.partial(data, columns=columns, filters=filters)
+        yield from run_registered(group, read, workers, cache, data_key)
+
+
+def combine(parts):
+    """Return result for all users from results for chunks of users.
+
+    Results are rows or series of users, which are concatenated in order
+    of users. Sparse tables are aligned on the union of their columns, as
+    a chunk only has columns of the categories its users spend on.
+    """
+    tables = [p for p in parts if is_sparse(p)]
+    if tables:
+        index = tables[0].index.name
+        rows = pd.Index(np.sort(np.concatenate([p.index for p in parts])),
+                        name=index)
+        columns = pd.Index(np.unique(np.concatenate(
+            [p.columns.to_numpy(dtype=object) for p in tables])))
+        long = pd.concat([to_long(p) for p in tables])
+        return from_long(long, index, rows=rows, columns=columns)
+    result = pd.concat(parts)
+    if isinstance(result, pd.DataFrame) and 'user_id' in result:
+        return result.sort_values('user_id', kind='stable',
+                                  ignore_index=True)
+    return result.sort_index(kind='stable')
+
+
+def run_chunk(group, reader):
+    """Return results of functions of group on chunk, or None if empty."""
+    df = reader()
+    if df.empty:
+        return None
+    return dict(run_registered(group, lambda: df))
+
+
+def _compute_chunk(task):
+    g, c = task
+    group, readers = _shared['groups'][g]
+    start = len(profile.records)
+    result = run_chunk(group, readers[c])
+    return g, c, result, profile.records[start:]
+
+
+def run_chunked(funcs, chunks, workers=1, cache=None, data_key=None):
+    """Yield name and result of each function, run on chunks of users.
+
+    chunks is a callable taking columns and filters and returning readers
+    of chunks, callables that each return a dataframe holding all rows of
+    their users. Functions are grouped as in run_declared, run on each
+    chunk as in run_registered, and their per-user results are combined,
+    so memory is bounded by a chunk rather than the sample. With more
+    than one worker, chunks of all groups are read and processed in a
+    single pool of forked processes. Empty chunks are skipped unless all
+    chunks are empty.
+    """
+    todo = []
+    for func in funcs:
+        key = stage_key(func, data_key, {}) if cache else None
+        result = cached(cache, key)
+        if result is None:
+            todo.append((func, key))
+        else:
+            yield func.__name__, result
+    keys = dict(todo)
+
+    groups = [(group, list(chunks(columns=columns, filters=filters)))
+              for columns, filters, group in declared_groups(keys)]
+    tasks = [(g, c) for g, (_, readers) in enumerate(groups)
+             for c in range(len(readers))]
+    parts = [{} for _ in groups]
+    left = [len(readers) for _, readers in groups]
+
+    def finish(g):
+        group, readers = groups[g]
+        results = [parts[g][c] for c in sorted(parts[g])
+                   if parts[g][c] is not None]
+        if not results and readers:
+            results = [dict(run_registered(group, readers[0]))]
+        for func in group:
+            result = combine([r[func.__name__] for r in results])
+            if cache:
+                cache.save(keys[func], result, {})
+            yield func.__name__, result
+
+    if workers > 1 and len(tasks) > 1:
+        _shared.update(groups=groups)
+        ctx = mp.get_context('fork')
+        try:
+            with ctx.Pool(min(workers, len(tasks))) as pool:
+                results = pool.imap_unordered(_compute_chunk, tasks)
+                for g, c, result, records in results:
+                    profile.records.extend(records)
+                    parts[g][c] = result
+                    left[g] -= 1
+                    if not left[g]:
+                        yield from finish(g)
+        finally:
+            _shared.clear()
+    else:
+        for g, c in tasks:
+            group, readers = groups[g]
+            parts[g][c] = run_chunk(group, readers[c])
+            left[g] -= 1
+            if not left[g]:
+                yield from finish(g)
+    for g in range(len(groups)):
+        if not groups[g][1]:
+            yield from finish(g)
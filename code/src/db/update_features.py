@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from .features import *
+from src.data.read_data import bucket_dirs, data_path, sample_users
+from .feature_store import FeatureStore
+from .registries import features_registry
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sample')
+    return parser.parse_args()
+
+
+def stats_path(sample):
+    """Return directory of feature statistics of sample.
+
+    Statistics are kept in the dataset they summarise, so that replacing
+    the dataset also removes them.
+    """
+    return os.path.join(data_path(sample), '_feature_stats')
+
+
+def update_features(sample):
+    """Update features of users with data added since the last update.
+
+    Feature statistics of delta files not yet processed are merged file
+    by file into the stored statistics, and features of users in those
+    files are recalculated from the merged statistics and replaced in the
+    feature store. Users who left the sample are removed from the store. All
+    registered features must be calculable from feature statistics.
+
+    Raises ValueError if the feature store has features but there are no
+    stored statistics, such as after add_features, since features of
+    changed users would then be calculated from new data only.
+    """
+    path = stats_path(sample)
+    done_path = os.path.join(path, 'deltas.json')
+    done = []
+    if os.path.exists(done_path):
+        with open(done_path) as f:
+            done = json.load(f)
+    files = [f for bucket in bucket_dirs(data_path(sample))
+             for f in os.scandir(bucket)]
+    deltas = sorted({f.name for f in files
+                     if f.name.startswith('delta-') and f.name not in done})
+    if not deltas:
+        print('Features are up to date.')
+        return
+
+    store = FeatureStore(sample)
+    if not done and store.groups():
+        raise ValueError(f'Feature store at {store.root} has no feature '
+                         'statistics. Remove it to build features from '
+                         'all delta files.')
+
+    stats = FeatureStats.load(path) if done else None
+    changed = []
+    for f in sorted(files, key=lambda f: f.name):
+        if f.name not in deltas:
+            continue
+        new = FeatureStats.from_data(
+            pd.read_parquet(f.path, columns=FeatureStats.COLUMNS))
+        stats = new if stats is None else stats.merge(new)
+        changed.append(new.sums.index)
+    changed = pd.Index(np.unique(np.concatenate(changed)), name='user_id')
+
+    users = changed[changed.isin(sample_users(sample))]
+    user_stats = stats.users(users)
+    for func in features_registry:
+        store.update(func.__name__, func(user_stats), changed)
+
+    stats.save(path)
+    with open(done_path, 'w') as f:
+        json.dump(done + deltas, f)
+    print(f'Features of {len(users)} users updated.')
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[:1]
+    args = parse_args(argv)
+    update_features(args.sample)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sys
+import pandas as pd
+from src import config
+from src.data.counter import count
+from src.helpers.helpers import from_long, is_sparse, to_long
+
+
+def hash_values(*values):
+    """Return hex digest of the reprs of values."""
+    h = hashlib.sha1()
+    for value in values:
+        h.update(repr(value).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def fingerprint(path):
+    """Return fingerprint of file or directory from sizes and mtimes."""
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, f)
+                       for root, _, names in os.walk(path) for f in names)
+    else:
+        files = [path]
+    stats = [(os.path.relpath(f, path), os.stat(f).st_size,
+              os.stat(f).st_mtime_ns) for f in files]
+    return hash_values(os.path.abspath(path), stats)
+
+
+def in_package(name):
+    """Return whether module name is in this package."""
+    package = __name__.split('.')[0]
+    return name == package or name.startswith(package + '.')
+
+
+def package_modules(module):
+    """Return module and the modules of this package it depends on.
+
+    Dependencies are the package modules, and the modules defining the
+    objects, that a module imports into its namespace, followed
+    transitively. Modules are sorted by name.
+    """
+    found = {}
+    todo = [module]
+    while todo:
+        mod = todo.pop()
+        if mod.__name__ in found:
+            continue
+        found[mod.__name__] = mod
+        for value in vars(mod).values():
+            if inspect.ismodule(value):
+                dep = value
+            else:
+                name = getattr(value, '__module__', None)
+                dep = sys.modules.get(name) if isinstance(name, str) else None
+            if (dep is not None and in_package(dep.__name__)
+                    and getattr(dep, '__file__', None)):
+                todo.append(dep)
+    return [found[name] for name in sorted(found)]
+
+
+@functools.lru_cache(maxsize=None)
+def source_hash(module):
+    """Return hash of source code of module and its package dependencies."""
+    return hash_values(*[(m.__name__, inspect.getsource(m))
+                         for m in package_modules(module)])
+
+
+def stage_key(func, input_key, params):
+    """Return cache key of stage.
+
+    Key changes if the input, the parameters, or the source of the module
+    defining the stage function or of any package module it depends on
+    change.
+    """
+    module = inspect.getmodule(func)
+    return hash_values(func.__module__, func.__qualname__,
+                       source_hash(module), input_key,
+                       sorted(params.items()))
+
+
+def count_delta(before):
+    """Return count entries that changed since before as python numbers."""
+    delta = {}
+    for k, v in count.items():
+        if k not in before or v != before[k]:
+            diff = v - before.get(k, 0)
+            delta[k] = diff.item() if hasattr(diff, 'item') else diff
+    return delta
+
+
+class StageCache:
+    """Parquet store of stage outputs.
+
+    Outputs are stored under their stage key together with the counts the
+    stage added, which are replayed on load so that the selection table
+    is complete. Least recently used outputs are evicted once the store
+    exceeds max_bytes.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        if root is None:
+            root = os.path.join(config.CACHEDIR, 'stages')
+        if max_bytes is None:
+            max_bytes = config.CACHE_MAX_BYTES
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.parquet')
+
+    def load(self, key):
+        """Load output and replay its counts. Returns output and counts.
+
+        Raises FileNotFoundError if output is not stored, which includes
+        outputs evicted by another process while loading. Counts are only
+        replayed once output is read.
+        """
+        fp = self.path(key)
+        os.utime(fp)
+        with open(fp + '.json') as f:
+            meta = json.load(f)
+        result = pd.read_parquet(fp)
+        count.update(meta['count'])
+        if meta['series'] is not None:
+            result = result.iloc[:, 0].rename(meta['series'])
+        elif meta.get('sparse') is not None:
+            result = from_long(result, index=result.columns[0],
+                               columns=pd.Index(meta['sparse']))
+        return result, meta['count']
+
+    def save(self, key, result, counts):
+        """Store output; sparse tables are stored as long dataframes."""
+        fp = self.path(key)
+        meta = {'series': None, 'sparse': None, 'count': counts}
+        if isinstance(result, pd.Series):
+            meta['series'] = result.name
+            result = result.to_frame(name=str(result.name))
+        elif is_sparse(result):
+            meta['sparse'] = list(result.columns)
+            result = to_long(result)
+        tmp = f'{fp}.{os.getpid()}.tmp'
+        result.to_parquet(tmp)
+        with open(tmp + '.json', 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp + '.json', fp + '.json')
+        os.replace(tmp, fp)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used outputs until store fits max_bytes.
+
+        Other processes may evict the same outputs concurrently, so files
+        that are already gone are skipped.
+        """
+        files = []
+        for f in os.scandir(self.root):
+            if f.name.endswith('.parquet'):
+                with contextlib.suppress(FileNotFoundError):
+                    stat = f.stat()
+                    files.append((stat.st_mtime, stat.st_size, f.path))
+        files.sort()
+        size = sum(fsize for _, fsize, _ in files)
+        for _, fsize, path in files[:-1]:
+            if size <= self.max_bytes:
+                break
+            size -= fsize
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path + '.json')
+
+    def compute(self, func, data, params, key, counts=None):
+        before = count.copy()
+        result = func(data, **params)
+        counts = dict(counts or {})
+        for k, v in count_delta(before).items():
+            counts[k] = counts.get(k, 0) + v
+        self.save(key, result, counts)
+        return result, counts
+
+    def run(self, func, input_key, load, **params):
+        """Return func(load(), **params), from cache if unchanged.
+
+        Input is only loaded if the output is not cached.
+        """
+        return self.run_stages([(func, params)], input_key, load)
+
+    def run_stages(self, stages, input_key, load):
+        """Run chain of (func, params) stages, starting from last cached.
+
+        Each stage's key depends on the key of the previous stage, so only
+        stages downstream of a change recompute. Counts are stored
+        cumulatively along the chain.
+        """
+        keys = []
+        for func, params in stages:
+            input_key = stage_key(func, input_key, params)
+            keys.append(input_key)
+        start = 0
+        for i in reversed(range(len(stages))):
+            try:
+                data, counts = self.load(keys[i])
+            except FileNotFoundError:
+                continue
+            start = i + 1
+            break
+        if not start:
+            data = load()
+            counts = {}
+        for (func, params), key in zip(stages[start:], keys[start:]):
+            data, counts = self.compute(func, data, params, key, counts)
+        return data
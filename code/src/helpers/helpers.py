@@ -1,5 +1,7 @@
 import os
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
 
 def export_latex_table(table, name, path=None, **kwargs):
@@ -45,3 +47,73 @@ def txn_data(df, txns):
 def tag_data(df, tag, var='auto_tag'):
     """Return data with specified tag."""
     return df[df[var].eq(tag)]
+
+
+def unique_values(s):
+    """Return codes of series values and series of unique values.
+
+    Missing values have code -1, so NaN is appended as last unique value.
+    """
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        codes, uniques = s.cat.codes.to_numpy(), s.cat.categories
+    else:
+        codes, uniques = pd.factorize(s)
+    uniques = np.append(np.asarray(uniques, dtype=object), np.nan)
+    return codes, pd.Series(uniques, dtype=object)
+
+
+def map_unique(s, func, categorical=False):
+    """Apply func to unique values of series and map result back to rows.
+
+    func takes and returns a series. String operations thus run once per
+    category rather than once per row.
+    """
+    codes, uniques = unique_values(s)
+    values = func(uniques)
+    if categorical:
+        new_codes, cats = pd.factorize(values, sort=True)
+        result = (pd.Categorical.from_codes(new_codes[codes], cats)
+                  .remove_unused_categories())
+    else:
+        result = values.to_numpy()[codes]
+    return pd.Series(result, index=s.index, name=s.name)
+
+
+def is_sparse(table):
+    """Return True if all columns of dataframe are sparse."""
+    return (isinstance(table, pd.DataFrame) and table.shape[1] > 0
+            and all(isinstance(t, pd.SparseDtype) for t in table.dtypes))
+
+
+def to_long(table):
+    """Return nonzero entries of sparse table as long dataframe.
+
+    Columns of result are the index, feature and value.
+    """
+    coo = table.sparse.to_coo()
+    index = table.index.name or 'index'
+    return pd.DataFrame({
+        index: table.index[coo.row],
+        'feature': table.columns[coo.col],
+        'value': coo.data,
+    })
+
+
+def from_long(long, index='user_id', rows=None, columns=None):
+    """Return sparse table from long dataframe of nonzero entries.
+
+    Rows and columns default to the sorted labels in long. Entries with
+    labels not in rows or columns are dropped.
+    """
+    if rows is None:
+        rows = pd.Index(np.sort(long[index].unique()), name=index)
+    if columns is None:
+        columns = pd.Index(np.sort(long.feature.unique()))
+    i = rows.get_indexer(long[index])
+    j = columns.get_indexer(long.feature)
+    keep = (i >= 0) & (j >= 0)
+    matrix = sparse.csr_matrix(
+        (long.value.to_numpy()[keep], (i[keep], j[keep])),
+        shape=(len(rows), len(columns)))
+    return pd.DataFrame.sparse.from_spmatrix(matrix, index=rows,
+                                             columns=columns)
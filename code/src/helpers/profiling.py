@@ -0,0 +1,185 @@
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+import pandas as pd
+
+
+# Set to 1 to profile pipeline steps, or to trace to also write a trace
+ENV_VAR = 'PROFILE_PIPELINE'
+
+# ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def frame_size(obj, deep=False):
+    """Return rows and bytes of dataframe or series, else Nones.
+
+    Bytes are shallow unless deep, which includes strings of object columns.
+    """
+    if isinstance(obj, pd.DataFrame):
+        return len(obj), int(obj.memory_usage(deep=deep).sum())
+    if isinstance(obj, pd.Series):
+        return len(obj), int(obj.memory_usage(deep=deep))
+    return None, None
+
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+class Profile:
+    """Resource usage of profiled pipeline steps.
+
+    Each call of a profiled step records wall and CPU time, the increase
+    in peak resident memory of the process, and rows and bytes of the
+    dataframe passed in and returned, shallow unless recording deep. While tracemalloc is tracing, it
+    also records the peak of traced allocations above those at the start
+    of the call. Calls record their depth, the number of profiled calls
+    they run in. Profiling is off unless enabled or the environment
+    variable is set, which also enables it in worker processes started
+    afterwards.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.enabled = os.environ.get(ENV_VAR, '0') != '0'
+        self.trace = os.environ.get(ENV_VAR) == 'trace'
+        self.deep = False
+        # Traced peaks of running calls, outermost first
+        self._peaks = []
+
+    def enable(self, trace=False):
+        self.enabled = True
+        self.trace = self.trace or trace
+        os.environ[ENV_VAR] = 'trace' if self.trace else '1'
+
+    def clear(self):
+        self.records.clear()
+
+    @contextmanager
+    def recording(self, deep=False):
+        """Profile calls in this process while in context.
+
+        With deep, bytes in and out include strings of object columns.
+        """
+        enabled, self.enabled = self.enabled, True
+        self.deep = deep
+        try:
+            yield
+        finally:
+            self.enabled = enabled
+            self.deep = False
+
+    def call(self, func, *args, **kwargs):
+        """Return result of func, recording its resource usage if enabled."""
+        if not self.enabled:
+            return func(*args, **kwargs)
+        traced = tracemalloc.is_tracing()
+        if traced:
+            base, peak = tracemalloc.get_traced_memory()
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], peak)
+            tracemalloc.reset_peak()
+        depth = len(self._peaks)
+        self._peaks.append(0)
+        rss = max_rss()
+        cpu = time.process_time()
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu
+            peak = self._peaks.pop()
+            if traced:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+        rows_in, bytes_in = (frame_size(args[0], self.deep) if args
+                             else (None, None))
+        rows_out, bytes_out = frame_size(result, self.deep)
+        self.records.append({
+            'step': func.__name__,
+            'module': func.__module__.rsplit('.', 1)[-1],
+            'pid': os.getpid(),
+            'depth': depth,
+            'start': start,
+            'wall': wall,
+            'cpu': cpu,
+            'rss_delta': max_rss() - rss,
+            'peak_traced': peak - base if traced else None,
+            'rows_in': rows_in,
+            'rows_out': rows_out,
+            'bytes_in': bytes_in,
+            'bytes_out': bytes_out,
+        })
+        return result
+
+    def table(self):
+        """Return usage by step, in order of total wall time.
+
+        Times of a step include those of profiled steps it calls.
+        """
+        records = pd.DataFrame(self.records)
+        if records.empty:
+            return records
+        g = records.groupby(['module', 'step'], sort=False)
+        tbl = pd.DataFrame({
+            'calls': g.size(),
+            'wall': g.wall.sum(),
+            'cpu': g.cpu.sum(),
+            'rss_delta_mb': g.rss_delta.max() / 1e6,
+            'rows_in': g.rows_in.sum(min_count=1),
+            'rows_out': g.rows_out.sum(min_count=1),
+            'mb_in': g.bytes_in.sum(min_count=1) / 1e6,
+            'mb_out': g.bytes_out.sum(min_count=1) / 1e6,
+        })
+        return tbl.sort_values('wall', ascending=False).reset_index()
+
+    def trace_events(self):
+        """Return records as Chrome trace events, in microseconds."""
+        events = []
+        for r in self.records:
+            args = {k: r[k] for k in ['cpu', 'rss_delta', 'rows_in',
+                                      'rows_out', 'bytes_in', 'bytes_out']}
+            events.append({
+                'name': r['step'],
+                'cat': r['module'],
+                'ph': 'X',
+                'ts': r['start'] * 1e6,
+                'dur': r['wall'] * 1e6,
+                'pid': r['pid'],
+                'tid': r['pid'],
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, name, dirpath):
+        """Write usage table and, if tracing, trace file of run name.
+
+        The trace file opens in chrome://tracing or Perfetto. Returns the
+        usage table.
+        """
+        tbl = self.table()
+        tbl.to_csv(os.path.join(dirpath, f'profile_{name}.csv'), index=False)
+        if self.trace:
+            fp = os.path.join(dirpath, f'profile_{name}.trace.json')
+            with open(fp, 'w') as f:
+                json.dump(self.trace_events(), f)
+        return tbl
+
+
+profile = Profile()
+
+
+def profiled(func):
+    """Record resource usage of each call of func if profiling is enabled."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return profile.call(func, *args, **kwargs)
+    return wrapper
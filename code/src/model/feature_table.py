@@ -1,45 +1,46 @@
-import os
-import sqlite3
 import pandas as pd
-from src import config
+from src.db.database import connection, db_path
+from src.db.feature_store import FeatureStore
 
 
-def feature_table(sample, experiment, order=False):
+FEATURES = [
+    'entropy',
+    'grocery_shop_freq',
+    'pct_credit',
+    'pct_manual_tags',
+    'merchant_spending_shares',
+    'tag_spending_shares',
+    'merchant_dummies',
+    'tag_dummies',
+]
+
+
+def feature_table(sample, experiment, groups=None, features=None,
+                  order=False, sparse=False):
     """Create dataframe with target and features.
 
-    Merge two tables as workaround of SQLite's 2,500 columns limit.
+    Target is the experiment's decision column, features are assembled
+    from the feature store for users with a target, reading only the
+    requested feature groups and features. With sparse, all features are
+    sparse columns, which sklearn converts to a sparse matrix without
+    densifying once the target is split off.
     """
-    db_path = config.DATADIR
-    db_name = f'features_{sample}.db'
-    db = os.path.join(db_path, db_name)
-    conn = sqlite3.connect(db)
-
     target = experiment
-    features = [
-        'entropy',
-        'grocery_shop_freq',
-        'pct_credit',
-        'pct_manual_tags',
-        'merchant_spending_shares',
-        'tag_spending_shares',
-        'merchant_dummies',
-        'tag_dummies',
-    ]
-
-    select = f'select * from {target} '
-    joins = ' '.join([f'join {f} using(user_id)' for f in features[:-2]])
-    table1 = pd.read_sql_query(select + joins, conn).set_index('user_id')
-
-    select = f'select * from {features[-2]} '
-    joins = ' '.join([f'join {f} using(user_id)' for f in features[-1:]])
-    table2 = pd.read_sql_query(select + joins, conn).set_index('user_id')
-
-    result = table1.join(table2)
+    query = f'select user_id, {target} from decisions'
+    with connection(db_path(sample)) as conn:
+        target = pd.read_sql_query(query, conn)
+    target = target.set_index('user_id').dropna()
+
+    if groups is None:
+        groups = FEATURES
+    table = FeatureStore(sample).table(groups, features, target.index,
+                                       sparse=sparse)
+    result = target.join(table, how='inner')
 
     # move dense features to front
     if order:
-        sparse = ['regyear', 'merch', 'merchshare', 'tag', 'tagshare']
-        regex = '|'.join(sparse)
+        prefixes = ['regyear', 'merch', 'merchshare', 'tag', 'tagshare']
+        regex = '|'.join(prefixes)
         last = result.columns[result.columns.str.contains(regex)]
         first = set(result.columns) - set(last)
         result = result[list(first) + list(last)]